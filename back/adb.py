@@ -0,0 +1,335 @@
+"""Async variant of the data-access functions of back/db.py.
+
+Supabase requests go through one shared async client, whose HTTP connections
+are kept alive between requests; local tables are read through the async psycopg
+pool. Functions have the same names, arguments and results as in back/db.py,
+cached ones share the cache (and its invalidation) with their sync counterparts.
+The pages of the dashboard (list_candidates, get_candidate_details) are only
+read here, their queries are built by back/db.py.
+"""
+import asyncio
+import logging
+from typing import Optional
+
+from fastapi import HTTPException
+from psycopg.rows import dict_row
+from supabase import acreate_client, AsyncClient
+
+from back import db
+from back.cache import shared_cache
+from back.db import HISTORY_PAGE_SIZE, CANDIDATES_PAGE_SIZE
+from back.metrics import observe_db
+from back.retry import retry, is_transient_not_applied
+from back.pool import get_async_pool
+from config import SUPABASE_URL, SUPABASE_KEY
+
+log = logging.getLogger(__name__)
+
+_client: Optional[AsyncClient] = None
+_client_lock = asyncio.Lock()
+
+
+async def get_client() -> AsyncClient:
+    """Process-wide async Supabase client, created on first use."""
+    global _client
+    if _client is None:
+        async with _client_lock:
+            if _client is None:
+                _client = await acreate_client(SUPABASE_URL, SUPABASE_KEY)
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.postgrest.aclose()
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_all_vacancies():
+    response = await (await get_client()).table("current_sessions").select("*").execute()
+    if response:
+        return response.data
+    else:
+        raise HTTPException(status_code=500, detail="Failed to retrieve vacancies")
+
+
+@retry(breaker='postgres')
+@observe_db
+async def list_candidates(vacancy_id: int, sort: str = 'score', state: Optional[str] = None,
+                          min_score: Optional[float] = None, max_score: Optional[float] = None,
+                          min_mark: Optional[int] = None, cursor: Optional[str] = None,
+                          limit: int = CANDIDATES_PAGE_SIZE):
+    """Page of the vacancy candidates sorted by aggregate mark ('score') or session date ('date').
+
+    Keyset paginated: pass the returned cursor to get the next page, returns (rows, next cursor or None).
+    """
+    queries = db.candidates_queries(vacancy_id, sort, state, min_score, max_score, min_mark, cursor)
+    rows = []
+    async with (await get_async_pool()).connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            for query, params in queries:
+                await cur.execute(query, {**params, 'limit': limit + 1 - len(rows)})
+                # one row more than the page to detect the next one
+                rows += await cur.fetchall()
+                if len(rows) > limit:
+                    break
+    return db.candidates_page(rows, sort, limit)
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_all_candidates():
+    response = await ((await get_client()).table("chat")
+                      .select("id, name, email, session:session_id(state)")
+                      .filter('session_id', 'neq', 'null')
+                      .execute())
+    if response:
+        return response.data
+    else:
+        raise HTTPException(status_code=500, detail="Failed to retrieve candidates")
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_latest_marks(chat_id: int, vacancy_id: int):
+    marks_response = await ((await get_client()).table("latest_marks")
+                            .select("*, marks:requirement_id(vacancy_id)")
+                            .eq("chat_id", chat_id)
+                            .eq("vacancy_id", vacancy_id)
+                            .execute())
+    if marks_response:
+        return marks_response.data
+    else:
+        raise HTTPException(status_code=500, detail="Failed to retrieve marks")
+
+
+@retry(breaker='postgres')
+@observe_db
+async def get_chat_history_page(chat_id: int, vacancy_id: int, before_id: Optional[int] = None,
+                                limit: int = HISTORY_PAGE_SIZE):
+    """Messages of the candidate's session for the vacancy, newest first.
+
+    Returns (messages with id < before_id, True if there are older messages).
+    """
+    async with (await get_async_pool()).connection() as conn:
+        async with conn.cursor(row_factory=dict_row) as cur:
+            await cur.execute(db.history_page_query(),
+                              {'chat_id': chat_id, 'vacancy_id': vacancy_id, 'before_id': before_id, 'limit': limit + 1})
+            rows = await cur.fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+async def get_candidate_details(chat_id: int, vacancy_id: int, before_id: Optional[int] = None):
+    """Candidate, marks and a page of the chat history for the candidate page, read concurrently."""
+    candidate, marks, (chat_history, has_more) = await asyncio.gather(
+        get_candidate_by_id(chat_id),
+        get_latest_marks(chat_id, vacancy_id),
+        get_chat_history_page(chat_id, vacancy_id, before_id))
+    if candidate is None:
+        raise HTTPException(status_code=404, detail="Candidate not found")
+    return candidate, marks, chat_history, has_more
+
+
+@shared_cache(db.get_vacancy)
+@retry(breaker='supabase')
+@observe_db
+async def get_vacancy(vacancy_id):
+    v = await ((await get_client()).table('vacancies')
+               .select('*')
+               .eq('id', vacancy_id)
+               .maybe_single()
+               .execute())
+    if v:
+        return v.data
+
+
+@shared_cache(db.get_opened_vacancies)
+@retry(breaker='supabase')
+@observe_db
+async def get_opened_vacancies():
+    v = await ((await get_client()).table('vacancies')
+               .select('id', 'name')
+               .execute())
+    if v:
+        return v.data
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_vacancy_id(vacancy_name):
+    v = await ((await get_client()).table('vacancies')
+               .select('id')
+               .eq('name', vacancy_name)
+               .maybe_single()
+               .execute())
+    if v:
+        return v.data
+
+
+@shared_cache(db.get_requirements_ids)
+@retry(breaker='supabase')
+@observe_db
+async def get_requirements_ids():
+    v = await ((await get_client()).table('requirements')
+               .select('id', 'name', 'vacancy_id')
+               .execute())
+    if v:
+        return v.data
+
+
+@shared_cache(db.get_requirements)
+@retry(breaker='supabase')
+@observe_db
+async def get_requirements(vacancy_id: int):
+    v = await ((await get_client()).table('requirements')
+               .select('*')
+               .eq('vacancy_id', vacancy_id)
+               .execute())
+    return v.data
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_session_state(chat_id):
+    state = await ((await get_client()).table('chat')
+                   .select("session:session_id(state)")
+                   .eq('id', chat_id)
+                   .maybe_single()
+                   .execute())
+    if state:
+        return state.data['session']['state']
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_candidate(email: str):
+    cand = await ((await get_client()).table('candidates')
+                  .select("id,name,resume")
+                  .eq('email', email.lower().strip())
+                  .filter('resume', 'neq', 'null')
+                  .maybe_single()
+                  .execute())
+    if cand:
+        return cand.data
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_chat(chat_id: int):
+    cand = await ((await get_client()).table('chat')
+                  .select("*")
+                  .eq('id', chat_id)
+                  .maybe_single()
+                  .execute())
+    if cand:
+        return cand.data
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_marks(chat_id: int, vacancy_id: int):
+    marks = await ((await get_client()).table('marks')
+                   .select("*")
+                   .eq('chat_id', chat_id)
+                   .eq('vacancy_id', vacancy_id)
+                   .execute())
+    if marks:
+        return marks.data
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_session(chat_id: int, vacancy_id: int):
+    sesh = await ((await get_client()).table('session')
+                  .select("*")
+                  .eq('chat_id', chat_id)
+                  .eq('vacancy_id', vacancy_id)
+                  .maybe_single()
+                  .execute())
+    if sesh:
+        return sesh.data
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_session_by_id(session_id: int):
+    sesh = await ((await get_client()).table('session')
+                  .select("*")
+                  .eq('id', session_id)
+                  .maybe_single()
+                  .execute())
+    if sesh:
+        return sesh.data
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_finished_session_ids(vacancy_id: int):
+    sessions = await ((await get_client()).table('session')
+                      .select("id")
+                      .eq('vacancy_id', vacancy_id)
+                      .eq('state', 'finished')
+                      .execute())
+    return [s['id'] for s in sessions.data]
+
+
+@retry(breaker='supabase')
+@observe_db
+async def get_candidate_by_id(id: int):
+    cand = await ((await get_client()).table('chat')
+                  .select("*")
+                  .eq('id', id)
+                  .maybe_single()
+                  .execute())
+    if cand:
+        return cand.data
+
+
+@retry(breaker='supabase')
+@observe_db
+async def upsert_session(chat_id, vacancy_id, state, cost: Optional[float] = None):
+    data = {
+        'chat_id': chat_id,
+        'vacancy_id': vacancy_id,
+        'state': state
+    }
+    if cost is not None:
+        data['cost'] = cost
+    await ((await get_client()).table('session')
+           .upsert(data, on_conflict='chat_id, vacancy_id')
+           .execute())
+
+
+@retry(breaker='supabase', transient=is_transient_not_applied)
+@observe_db
+async def update_cost(session_id, value):
+    await (await get_client()).rpc('increment_cost', {'x': value, 'sesh_id': session_id}).execute()
+
+
+@retry(breaker='supabase')
+@observe_db
+async def update_marks(cand_id, marks):
+    await ((await get_client()).table('marks')
+           .upsert([dict(chat_id=cand_id, requirement_id=id, value=val) for id, val in marks.items()])
+           .execute())
+
+
+@retry(breaker='supabase')
+@observe_db
+async def update_chat_info(chat_id, name: Optional[str] = None, email: Optional[str] = None,
+                           new_resume: Optional[str] = None, session_id: Optional[int] = None):
+    data = {
+        'id': chat_id
+    }
+    if name is not None:
+        data['name'] = name
+    if email is not None:
+        data['email'] = email
+    if new_resume is not None:
+        data['resume'] = new_resume
+    if session_id is not None:
+        data['session_id'] = session_id
+    await (await get_client()).table('chat').upsert(data).execute()
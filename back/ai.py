@@ -1,145 +1,339 @@
 import argparse
+import hashlib
 import logging
-import uuid
+import threading
+from collections import OrderedDict
 
-import psycopg
 from langchain_community.callbacks import get_openai_callback
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from langchain_core.output_parsers import PydanticOutputParser
 from langchain_core.prompts import PromptTemplate, ChatPromptTemplate, MessagesPlaceholder, SystemMessagePromptTemplate
+from langchain_core.utils.function_calling import convert_to_openai_function
+from langchain_core.utils.json import parse_json_markdown
 from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import START, MessagesState, StateGraph, END
-from pydantic import create_model, BaseModel, Field
+from pydantic import create_model, BaseModel, ConfigDict, Field, ValidationError
 
 # from langchain_postgres import PostgresChatMessageHistory
-from back.custom_postgres import PostgresChatMessageHistory
-from back.db import get_session_by_id, get_chat, get_requirements, table_name
-from config import OPEN_AI_KEY, conn_info
+from back.custom_postgres import PostgresChatMessageHistory, HistoryCache, HistoryWriter
+from back.db import (get_session_by_id, get_chat, get_requirements, table_name, transform_marks,
+                     update_marks, get_finished_session_ids, update_session_score)
+from back.checkpoint import LatestCheckpointSaver
+from back.context import ContextBudget
+from back.metrics import llm_seconds, llm_tokens, llm_cost
+from back.pool import get_pool
+from back.streaming import stream_question, partial_question
+from config import (OPEN_AI_KEY, HISTORY_CACHE_SESSIONS, HISTORY_WRITE_MODE, HISTORY_WRITE_BATCH,
+                    CONTEXT_TOKEN_BUDGET, CONTEXT_KEEP_TURNS)
 
 log = logging.getLogger(__name__)
 
-# Create an instance of the OpenAI LLM
-chat = ChatOpenAI(model="gpt-4.1-mini", api_key=OPEN_AI_KEY)
+# Create an instance of the OpenAI LLM, stream_usage - token usage (and cost) is reported for streamed replies too
+chat = ChatOpenAI(model="gpt-4.1-mini", api_key=OPEN_AI_KEY, stream_usage=True)
 
 with open('back/hr_prompt.md', encoding='utf-8') as f:
     top_template = f.read()
-with open('back/hr_prompt2.md', encoding='utf-8') as f:
-    bot_template = f.read()
+with open('back/vacancy_prompt.md', encoding='utf-8') as f:
+    vacancy_template = f.read()
+with open('back/resume_prompt.md', encoding='utf-8') as f:
+    resume_template = f.read()
 with open('back/start_msg.md', encoding='utf-8') as f:
     start_template = f.read()
 with open('back/evaluate_prompt.md', encoding='utf-8') as f:
     eval_template = f.read()
 
+history_cache = HistoryCache(max_sessions=HISTORY_CACHE_SESSIONS)
+history_writer = (HistoryWriter(lambda: get_pool().connection(), max_batch=HISTORY_WRITE_BATCH)
+                  if HISTORY_WRITE_MODE == 'batch' else None)
+
+
+def wait_history_written(session_id: int, timeout=None) -> bool:
+    """Wait until the chat history of the session is stored, so that any process reads all of it.
+
+    Only waits with HISTORY_WRITE_MODE=batch, returns False if the messages are still pending after timeout.
+    """
+    if history_writer is None:
+        return True
+    return history_writer.wait((table_name, session_id), timeout)
+
 
 def get_session_history(session_id: int, connection) -> PostgresChatMessageHistory:
     return PostgresChatMessageHistory(
         table_name,
         session_id,
-        sync_connection=connection
+        sync_connection=connection,
+        cache=history_cache,
+        writer=history_writer
     )
 
 class State(MessagesState):
     is_finished: bool
+    # tokens of the last prompt sent to the model and how many of them the provider served from cache
+    prompt_tokens: int
+    cached_tokens: int
 
 class Result(BaseModel):
     """Answer to user query."""
-    question: str
+    model_config = ConfigDict(extra='forbid')
+
+    question: str = Field(
+        ..., description="""The next question to the candidate, or the closing remark when the interview is finished."""
+    )
     finished: bool = Field(
         ..., description="""Indicates that the interview is finished."""
     )
 
-def start_chat(session_id, cand, requirements):
-    config = {"configurable": {"thread_id": session_id}}
 
-    # class State(MessagesState):
-    #     input: str
-    parser = PydanticOutputParser(pydantic_object=Result)
-
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            SystemMessagePromptTemplate.from_template(top_template).format(requirements='\n'.join([f"* {r['name']} : {r['description']}"
-                                                                              for r in requirements]),
-                                                      resume=cand['resume']),
-            MessagesPlaceholder(variable_name="messages"),
-            SystemMessagePromptTemplate.from_template(bot_template).format(format_instructions=parser.get_format_instructions())
-            #('human', '{input}')
-        ]
-    )
+PROMPT_CACHE_SIZE = 128
 
 
+def _response_format(model) -> dict:
+    function = convert_to_openai_function(model, strict=True)
+    return {'type': 'json_schema',
+            'json_schema': {'name': function['name'], 'description': function['description'],
+                            'schema': function['parameters'], 'strict': True}}
 
 
+# The interviewer replies with the JSON of Result, the schema is enforced by the provider
+# (structured outputs) instead of format instructions in the prompt. The response format is
+# bound as a dict, not the pydantic class, so that the reply can still be streamed.
+interview_model = chat.bind(response_format=_response_format(Result))
+
+# The prompt is ordered from the most to the least shared content: instructions (all sessions),
+# requirements (vacancy), resume (candidate), then the conversation, which only grows. Every turn
+# thus repeats the previous prompt as a prefix, which the provider serves from its prompt cache.
+instructions_message = SystemMessage(content=top_template)
+
+# per-session system messages (requirements and resume) come through config['configurable']['system']
+prompt = ChatPromptTemplate.from_messages(
+    [
+        instructions_message,
+        MessagesPlaceholder(variable_name="system"),
+        MessagesPlaceholder(variable_name="messages"),
+    ]
+)
+
+context_budget = ContextBudget(chat, CONTEXT_TOKEN_BUDGET, keep_turns=CONTEXT_KEEP_TURNS) if CONTEXT_TOKEN_BUDGET else None
+
+_vacancy_prompts = OrderedDict()
+_vacancy_prompts_lock = threading.Lock()
+
+
+def requirements_digest(requirements) -> str:
+    """Content hash of the requirements that end up in the prompt."""
+    h = hashlib.sha256()
+    for r in requirements:
+        h.update(f"{r['name']}\0{r['description']}\0".encode('utf-8'))
+    return h.hexdigest()
+
+
+def render_requirements(requirements) -> str:
+    return '\n'.join([f"* {r['name']} : {r['description']}" for r in requirements])
+
+
+def vacancy_prompt(requirements) -> SystemMessage:
+    """System message with the requirements of the vacancy.
+
+    LRU cached by vacancy id and content hash of the requirements, so changed requirements
+    are picked up without explicit invalidation.
+    """
+    vacancy_id = requirements[0]['vacancy_id'] if requirements else None
+    key = (vacancy_id, requirements_digest(requirements))
+    with _vacancy_prompts_lock:
+        message = _vacancy_prompts.get(key)
+        if message is not None:
+            _vacancy_prompts.move_to_end(key)
+            return message
+    message = SystemMessage(content=PromptTemplate.from_template(vacancy_template).format(requirements=render_requirements(requirements)))
+    with _vacancy_prompts_lock:
+        _vacancy_prompts[key] = message
+        if len(_vacancy_prompts) > PROMPT_CACHE_SIZE:
+            _vacancy_prompts.popitem(last=False)
+    return message
+
+
+def resume_prompt(cand) -> SystemMessage:
+    return SystemMessage(content=PromptTemplate.from_template(resume_template).format(resume=cand['resume']))
+
+
+def usage_tokens(response):
+    """Return (input tokens, input tokens served from the provider prompt cache) of a model reply."""
+    usage = response.usage_metadata or {}
+    return usage.get('input_tokens', 0), (usage.get('input_token_details') or {}).get('cache_read', 0)
+
+
+def reply_result(message: AIMessage) -> Result:
+    """Parsed interviewer reply.
+
+    Not stored with the message, a resumed session parses only its last reply (see SessionSnapshot).
+    """
+    text = message.content or message.additional_kwargs.get('refusal') or ''
+    try:
+        result = Result.model_validate_json(text)
+    except ValidationError:
+        try:
+            # replies stored before structured outputs, JSON possibly in a markdown block
+            result = Result.model_validate(parse_json_markdown(text))
+        except (ValidationError, ValueError) as e:
+            # truncated or refused reply, show the candidate what there is instead of failing the turn
+            log.warning(f'Malformed interviewer reply: {str(e)}')
+            result = Result(question=partial_question(text) or text, finished=False)
+    # the parsed copy is not stored in chat_history with the reply
+    message.additional_kwargs.pop('parsed', None)
+    return result
+
+
+class SessionSnapshot:
+    """Conversation of an interview session and the result of its last interviewer reply.
+
+    Read from chat_history once and passed to the graph in config['configurable']['snapshot'],
+    call_model takes the conversation from it and appends every new turn, so the history is not
+    read again while the snapshot is used.
+    """
+
+    def __init__(self, session_id: int, messages):
+        self.session_id = session_id
+        self.messages = list(messages)
+        self.last_result = None
+        for message in reversed(self.messages):
+            if message.type == 'ai':
+                self.last_result = reply_result(message)
+                break
 
-    def call_model(state: State, config: dict):
-        # Use the chat model to generate a response
-        with psycopg.connect(conn_info, prepare_threshold=None) as conn:
-            previous_messages = []
-            session_id = config.get('configurable').get('thread_id')
-            chat_history = get_session_history(session_id, conn)
-            if len(state['messages']) <= 2:
-                    previous_messages = chat_history.messages
-            if previous_messages:
-                all_messages = previous_messages + state['messages']
-                response = chat.invoke(prompt.invoke(all_messages))
-            else:
-                prompted_messages = prompt.invoke(state['messages'])
-                response = chat.invoke(prompted_messages)
-            structured_response = {"messages": [AIMessage(content = parser.invoke(response.content).question)], "is_finished": parser.invoke(response.content).finished}
-            chat_history.add_messages([state['messages'][-1]] + [response])
-            return structured_response
-
-
-
-    workflow = StateGraph(state_schema=State)
-    workflow.add_node('talk_to_candidate', call_model)
-    workflow.add_edge(START, 'talk_to_candidate')
-    workflow.add_edge('talk_to_candidate', END)
-    #workflow.add_node("set_marks", set_marks)
-
-    memory = MemorySaver()
-    graph = workflow.compile(checkpointer=memory)
-
-    prev_history = None
-    with psycopg.connect(conn_info, prepare_threshold=None) as conn:
+    @classmethod
+    def load(cls, session_id: int) -> 'SessionSnapshot':
+        with get_pool().connection() as conn:
+            return cls(session_id, get_session_history(session_id, conn).messages)
+
+    def add(self, messages, result: Result):
+        self.messages.extend(messages)
+        self.last_result = result
+
+
+def call_model(state: State, config: dict):
+    # Use the chat model to generate a response
+    system = config.get('configurable').get('system')
+    snapshot = config.get('configurable').get('snapshot')
+    session_id = config.get('configurable').get('thread_id')
+    # the graph state holds only the new input, the conversation comes from the snapshot
+    all_messages = snapshot.messages + state['messages'][-1:]
+    prompt_tokens = None
+    if context_budget is not None:
+        all_messages, stats = context_budget.fit(session_id, [instructions_message] + system, all_messages)
+        prompt_tokens = stats['prompt_tokens']
+    prompted_messages = prompt.invoke({'system': system, 'messages': all_messages})
+    on_question = config.get('configurable').get('on_question')
+    with llm_seconds.time(call='interview'):
+        if on_question is None:
+            response = interview_model.invoke(prompted_messages)
+        else:
+            response = stream_question(interview_model, prompted_messages, on_question)
+    input_tokens, cached_tokens = usage_tokens(response)
+    llm_tokens.inc(cached_tokens, call='interview', kind='cached')
+    log.info(f'Input tokens - {input_tokens}, cached {cached_tokens}, uncached {input_tokens - cached_tokens}')
+    result = reply_result(response)
+    structured_response = {"messages": [AIMessage(content=result.question)], "is_finished": result.finished,
+                           "prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens}
+    turn = [state['messages'][-1], response]
+    # a connection is taken only for the write, not held while the model answers
+    with get_pool().connection() as conn:
+        get_session_history(session_id, conn).add_messages(turn)
+    snapshot.add(turn, result)
+    return structured_response
+
+
+workflow = StateGraph(state_schema=State)
+workflow.add_node('talk_to_candidate', call_model)
+workflow.add_edge(START, 'talk_to_candidate')
+workflow.add_edge('talk_to_candidate', END)
+#workflow.add_node("set_marks", set_marks)
+
+# the conversation is persisted in chat_history, checkpoints are only needed while a graph run lasts
+memory = LatestCheckpointSaver()
+graph = workflow.compile(checkpointer=memory)
+
+
+def _reset_thread(thread_id):
+    """Drop checkpoints of the thread, so a (re)started session begins with an empty state."""
+    memory.delete_thread(thread_id)
+
+
+def _record_usage(call, cb):
+    llm_cost.inc(cb.total_cost, call=call)
+    llm_tokens.inc(cb.prompt_tokens, call=call, kind='prompt')
+    llm_tokens.inc(cb.completion_tokens, call=call, kind='completion')
+
+
+def _session_config(session_id, cand, requirements, snapshot: SessionSnapshot):
+    # the system messages and the snapshot are passed as objects, not strings, so that
+    # langgraph does not copy them into the metadata of every checkpoint
+    system = [vacancy_prompt(requirements), resume_prompt(cand)]
+    return {"configurable": {"thread_id": session_id, "system": system, "snapshot": snapshot}}
+
+
+def _with_on_question(config, on_question):
+    """Config of a single graph run streaming the question text to on_question."""
+    if on_question is None:
+        return config
+    return {**config, "configurable": {**config["configurable"], "on_question": on_question}}
+
+
+def _candidate_processor(config):
+    def process_candidate_input(input, on_question=None):
+        log.info(f'user : {input}')
         session_id = config.get('configurable').get('thread_id')
-        chat_history = get_session_history(session_id, conn)
-        if chat_history.messages:
-            prev_history = chat_history.messages
+        snapshot = config.get('configurable').get('snapshot')
+        # every turn starts from an empty graph state and call_model takes the conversation
+        # from the snapshot of chat_history, so consecutive turns may be handled by different processes
+        _reset_thread(session_id)
+        user_state = {'messages': [HumanMessage(content=input)]}
+        with get_openai_callback() as cb:
+            try:
+                resp = graph.invoke(user_state, _with_on_question(config, on_question))
+            finally:
+                _reset_thread(session_id)
+            log.info(f'Question - ${cb.total_cost:.4f}, prompt {resp.get("prompt_tokens")} tokens, {resp.get("cached_tokens")} cached')
+            _record_usage('interview', cb)
+            cost = cb.total_cost
+        msg = resp['messages'][-1].content
+        finish = resp['is_finished']
+        return msg, finish, list(snapshot.messages), cost
+
+    return process_candidate_input
+
+
+def start_chat(session_id, cand, requirements, on_question=None):
+    """Start or resume the interview session.
+
+    on_question - optional callback receiving the growing text of the greeting while it streams.
+    """
+    snapshot = SessionSnapshot.load(session_id)
+    config = _session_config(session_id, cand, requirements, snapshot)
+    _reset_thread(session_id)
 
     cost = 0
 
-    if prev_history is not None:
-        for msg in reversed(prev_history):
-            if msg.type == 'ai':
-                greeting = {"messages": [AIMessage(content=parser.invoke(msg.content).question)],
-                            "is_finished": parser.invoke(msg.content).finished}
-                break
+    if snapshot.last_result is not None:
+        # resumed session, the last question is repeated
+        result = snapshot.last_result
+        greeting = {"messages": [AIMessage(content=result.question)], "is_finished": result.finished}
     else:
         start_msg = PromptTemplate.from_template(start_template).format(name=cand['name'])
         initial_state = {'messages': [SystemMessage(content=start_msg)], 'is_finished': False}
         with get_openai_callback() as cb:
-            greeting = graph.invoke(initial_state, config)
+            try:
+                greeting = graph.invoke(initial_state, _with_on_question(config, on_question))
+            finally:
+                _reset_thread(session_id)
             log.info(f'Greeting - ${cb.total_cost:.4f}')
+            _record_usage('interview', cb)
             cost = cb.total_cost
 
-    def process_candidate_input(input):
-        log.info(f'user : {input}')
-        user_state = {'messages': [HumanMessage(content=input)]}
-        with get_openai_callback() as cb:
-            resp = graph.invoke(user_state, config)
-            log.info(f'Question - ${cb.total_cost:.4f}')
-            cost = cb.total_cost
-        msg = resp['messages'][-1].content
-        finish = resp['is_finished']
+    return greeting, _candidate_processor(config), cost
 
-        session_id = config.get('configurable').get('thread_id')
-        session_id_uuid = uuid.UUID(int=session_id)
-        with psycopg.connect(conn_info, prepare_threshold=None) as conn:
-            hist = get_session_history(session_id, conn).messages
-            return msg, finish, hist, cost
 
-    return greeting, process_candidate_input, cost
+def resume_chat(session_id, cand, requirements):
+    """Candidate input processor of an already started session, without the greeting step."""
+    return _candidate_processor(_session_config(session_id, cand, requirements, SessionSnapshot.load(session_id)))
 
 
 
@@ -148,8 +342,7 @@ def evaluate(session_id, cand, requirements):
     prompt = ChatPromptTemplate.from_messages(
         [
             SystemMessagePromptTemplate.from_template(eval_template).format(
-                requirements='\n'.join([f"* {r['name']} : {r['description']}"
-                                        for r in requirements]),
+                requirements=render_requirements(requirements),
                 resume=cand['resume']),
             MessagesPlaceholder(variable_name="messages"),
             # ('human', '{input}')
@@ -165,17 +358,19 @@ def evaluate(session_id, cand, requirements):
 
     def call_evaluate(config: dict):
         # Use the chat model to generate a response
-        with psycopg.connect(conn_info, prepare_threshold=None) as conn:
+        with get_pool().connection() as conn:
             session_id = config.get('configurable').get('thread_id')
             chat_history = get_session_history(session_id, conn)
             previous_messages = chat_history.messages
             prompted_messages = prompt.invoke(previous_messages)
-            response = llm_with_tools.invoke(prompted_messages)
+            with llm_seconds.time(call='evaluation'):
+                response = llm_with_tools.invoke(prompted_messages)
             return {"messages": response}
 
     with get_openai_callback() as cb:
         resp = call_evaluate(config)
         log.info(f'Question - ${cb.total_cost:.4f}')
+        _record_usage('evaluation', cb)
     marks = None
     for tc in resp['messages'].tool_calls or []:
         if tc['name'] == Marks.__name__:
@@ -184,26 +379,62 @@ def evaluate(session_id, cand, requirements):
         log.info(f'Set marks : {marks}')
     return marks
 
+def score_session(session_id):
+    """Evaluate a finished session and store the marks, returns marks by requirement id."""
+    sesh = get_session_by_id(session_id)
+    vacancy_id = sesh['vacancy_id']
+    requirements = get_requirements(vacancy_id)
+    cand = get_chat(sesh['chat_id'])
+    marks = evaluate(session_id, cand, requirements)
+    if not marks:
+        raise ValueError(f'Evaluation of session {session_id} returned no marks')
+    id_marks = transform_marks(marks, vacancy_id)
+    if not id_marks:
+        raise ValueError(f'Evaluation of session {session_id} returned marks for unknown requirements {list(marks)}')
+    update_marks(sesh['chat_id'], id_marks)
+    update_session_score(session_id, vacancy_id, id_marks)
+    return id_marks
+
+
+def rescore_vacancy(vacancy_id, workers):
+    """Re-evaluate every finished session of the vacancy, `workers` sessions in parallel."""
+    from back.jobs import EvaluationWorkers, enqueue_evaluation
+
+    session_ids = get_finished_session_ids(vacancy_id)
+    log.info(f'Re-scoring {len(session_ids)} sessions of vacancy {vacancy_id}')
+    for session_id in session_ids:
+        enqueue_evaluation(session_id)
+    EvaluationWorkers(score_session, concurrency=workers).run_until_empty()
+
+
 def main(args):
+    if args.rescore_vacancy is not None:
+        rescore_vacancy(args.rescore_vacancy, args.workers)
+        return
     sesh = get_session_by_id(args.session_id)
     vac_id = sesh['vacancy_id']
     reqs = get_requirements(vac_id)
     cand = get_chat(sesh['chat_id'])
-    greeting, chat_processor = start_chat(args.session_id, cand, reqs)
+    greeting, chat_processor, cost = start_chat(args.session_id, cand, reqs)
     print(greeting)
     while (S:=input('Enter your query: ')) != 'exit':
-        msg, finish, hist = chat_processor(S)
+        msg, finish, hist, cost = chat_processor(S)
         print(msg)
         if finish:
             break
+    if history_writer is not None:
+        history_writer.stop()
 
 if __name__ == "__main__":
 
     # Create an ArgumentParser object parser = argparse.ArgumentParser(description="Query processor")
-    parser = argparse.ArgumentParser()
+    arg_parser = argparse.ArgumentParser()
     # Add an argument for the query
-    parser.add_argument("--session_id", type=int, default =2, help="Enter your query")
+    arg_parser.add_argument("--session_id", type=int, default =2, help="Enter your query")
+    arg_parser.add_argument("--rescore_vacancy", type=int, default=None,
+                            help="Re-evaluate all finished sessions of the vacancy")
+    arg_parser.add_argument("--workers", type=int, default=4, help="Parallel evaluations for --rescore_vacancy")
 
     # Parse the arguments
-    args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    args = arg_parser.parse_args()
+    main(args)
@@ -0,0 +1,111 @@
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+from back import metrics
+
+_caches = {}
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire `ttl` seconds after they were stored."""
+
+    def __init__(self, ttl: float, maxsize: int = 256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, value = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def info(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+_MISSING = object()
+
+
+def ttl_cache(ttl: float, maxsize: int = 256):
+    """Read-through cache decorator for functions with hashable positional arguments.
+
+    None results are not cached. The wrapped function gets `invalidate(*args)`,
+    `cache_clear()` and `cache_info()`. Cached values are shared, callers must not modify them.
+    """
+    def decorator(func):
+        cache = TTLCache(ttl, maxsize)
+        _caches[func.__name__] = cache
+        # read on every scrape
+        metrics.cache_hits.set_function(lambda: cache.info()['hits'], function=func.__name__)
+        metrics.cache_misses.set_function(lambda: cache.info()['misses'], function=func.__name__)
+        metrics.cache_size.set_function(lambda: cache.info()['size'], function=func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            value = cache.get(args, _MISSING)
+            if value is _MISSING:
+                value = func(*args)
+                if value is not None:
+                    cache.set(args, value)
+            return value
+
+        wrapper.cache = cache
+        wrapper.invalidate = lambda *args: cache.pop(args)
+        wrapper.cache_clear = cache.clear
+        wrapper.cache_info = cache.info
+        return wrapper
+    return decorator
+
+
+def shared_cache(cached):
+    """Cache decorator of a coroutine function sharing the cache of the ttl_cache decorated `cached`.
+
+    For async variants of cached functions, invalidation of `cached` applies to both.
+    """
+    def decorator(func):
+        cache = cached.cache
+
+        @functools.wraps(func)
+        async def wrapper(*args):
+            value = cache.get(args, _MISSING)
+            if value is _MISSING:
+                value = await func(*args)
+                if value is not None:
+                    cache.set(args, value)
+            return value
+        return wrapper
+    return decorator
+
+
+def cache_stats() -> dict:
+    """Hit/miss statistics of all ttl_cache decorated functions by function name."""
+    return {name: cache.info() for name, cache in _caches.items()}
@@ -0,0 +1,77 @@
+"""Persistent per-chat state of the bot conversation.
+
+The state tells the dispatcher which handler the next message of a chat goes to,
+together with the vacancy and session of a running interview, so that any worker
+process can continue any conversation.
+"""
+import logging
+
+from psycopg import sql
+from psycopg.rows import dict_row
+
+from back.pool import get_pool
+
+log = logging.getLogger(__name__)
+
+table_name = 'chat_state'
+
+# waiting for the candidate's full name
+AWAIT_FIO = 'await_fio'
+# waiting for the email
+AWAIT_EMAIL = 'await_email'
+# waiting for the resume in .pdf
+AWAIT_RESUME = 'await_resume'
+# vacancies were shown, waiting for a vacancy button to be pressed
+SELECT_VACANCY = 'select_vacancy'
+# interview in progress, messages are answers to the interviewer
+INTERVIEW = 'interview'
+
+
+def create_tables(connection):
+    connection.execute(sql.SQL(
+        """
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            chat_id BIGINT PRIMARY KEY,
+            state TEXT NOT NULL,
+            vacancy_id INTEGER,
+            session_id INTEGER,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """
+    ).format(table_name=sql.Identifier(table_name)))
+    connection.commit()
+
+
+def get_chat_state(chat_id: int):
+    """Return dict(chat_id, state, vacancy_id, session_id) or None if the chat has no state."""
+    query = sql.SQL(
+        "SELECT chat_id, state, vacancy_id, session_id FROM {table_name} WHERE chat_id = %s"
+    ).format(table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(query, (chat_id,))
+            return cur.fetchone()
+
+
+def set_chat_state(chat_id: int, state: str, vacancy_id: int = None, session_id: int = None):
+    query = sql.SQL(
+        "INSERT INTO {table_name} (chat_id, state, vacancy_id, session_id) VALUES (%s, %s, %s, %s) "
+        "ON CONFLICT (chat_id) DO UPDATE SET state = EXCLUDED.state, vacancy_id = EXCLUDED.vacancy_id, "
+        "session_id = EXCLUDED.session_id, updated_at = NOW()"
+    ).format(table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        conn.execute(query, (chat_id, state, vacancy_id, session_id))
+    log.info(f'Chat {chat_id} -> {state}')
+
+
+def clear_chat_state(chat_id: int):
+    query = sql.SQL("DELETE FROM {table_name} WHERE chat_id = %s").format(table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        conn.execute(query, (chat_id,))
+
+
+def count_chats(state: str, timeout: float = None) -> int:
+    """Chats in the state, waiting at most `timeout` seconds for a connection (the pool default if None)."""
+    query = sql.SQL("SELECT count(*) FROM {table_name} WHERE state = %s").format(table_name=sql.Identifier(table_name))
+    with get_pool().connection(timeout=timeout) as conn:
+        return conn.execute(query, (state,)).fetchone()[0]
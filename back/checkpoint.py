@@ -0,0 +1,97 @@
+"""Bounded in-memory checkpointer of the interview graph.
+
+The graph takes the conversation from chat_history (see SessionSnapshot in
+back/ai.py), its checkpoints are only needed while a turn runs. Unlike
+MemorySaver, which keeps every checkpoint of every thread for the life of the
+process, LatestCheckpointSaver keeps the latest checkpoint of a thread (and its
+parent, whose writes LangGraph reads), drops threads idle for `idle_ttl`
+seconds and keeps at most `max_threads` threads, least recently used first out.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from langgraph.checkpoint.memory import MemorySaver
+
+from config import CHECKPOINT_MAX_THREADS, CHECKPOINT_IDLE_TTL
+
+log = logging.getLogger(__name__)
+
+
+class LatestCheckpointSaver(MemorySaver):
+    """MemorySaver keeping only the latest state of a bounded number of threads."""
+
+    def __init__(self, max_threads: int = CHECKPOINT_MAX_THREADS, idle_ttl: float = CHECKPOINT_IDLE_TTL):
+        super().__init__()
+        self.max_threads = max_threads
+        self.idle_ttl = idle_ttl
+        self._lock = threading.RLock()
+        self._used = OrderedDict()  # thread_id -> monotonic time of the last use, oldest first
+        self.evicted = 0
+
+    def get_tuple(self, config):
+        with self._lock:
+            self._touch(config['configurable']['thread_id'])
+            return super().get_tuple(config)
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        with self._lock:
+            # materialized, the lock is not held while the caller iterates
+            return iter([*super().list(config, filter=filter, before=before, limit=limit)])
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        with self._lock:
+            thread_id = config['configurable']['thread_id']
+            checkpoint_ns = config['configurable']['checkpoint_ns']
+            keep = {checkpoint['id'], config['configurable'].get('checkpoint_id')}
+            saved = super().put(config, checkpoint, metadata, new_versions)
+            checkpoints = self.storage[thread_id][checkpoint_ns]
+            for checkpoint_id in [c for c in checkpoints if c not in keep]:
+                del checkpoints[checkpoint_id]
+                self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            self._touch(thread_id)
+            self._evict()
+            return saved
+
+    def put_writes(self, config, writes, task_id, task_path=''):
+        with self._lock:
+            self._touch(config['configurable']['thread_id'])
+            return super().put_writes(config, writes, task_id, task_path)
+
+    def delete_thread(self, thread_id):
+        """Drop all checkpoints and writes of the thread."""
+        with self._lock:
+            self._used.pop(thread_id, None)
+            self.storage.pop(thread_id, None)
+            for key in [k for k in self.writes if k[0] == thread_id]:
+                del self.writes[key]
+
+    def stats(self) -> dict:
+        """Threads, checkpoints and bytes of serialized state held in memory."""
+        with self._lock:
+            checkpoints = 0
+            size = 0
+            for namespaces in self.storage.values():
+                for saved in namespaces.values():
+                    checkpoints += len(saved)
+                    for (_, checkpoint), (_, metadata), _ in saved.values():
+                        size += len(checkpoint) + len(metadata)
+            for writes in self.writes.values():
+                size += sum(len(value) for _, _, (_, value), _ in writes.values())
+            return {'threads': len(self.storage), 'checkpoints': checkpoints, 'bytes': size,
+                    'evicted': self.evicted}
+
+    def _touch(self, thread_id):
+        self._used[thread_id] = time.monotonic()
+        self._used.move_to_end(thread_id)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._used:
+            thread_id, used = next(iter(self._used.items()))
+            if len(self._used) <= self.max_threads and now - used < self.idle_ttl:
+                break
+            self.delete_thread(thread_id)
+            self.evicted += 1
+            log.debug(f'Evicted checkpoints of thread {thread_id}')
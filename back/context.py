@@ -0,0 +1,154 @@
+"""Token budget of the interview prompt.
+
+When the conversation does not fit into the budget, the oldest messages are replaced
+by a summary. The summary is stored per session and updated incrementally: it covers
+a prefix of the history and is extended only when the verbatim tail outgrows the budget.
+"""
+import logging
+from functools import lru_cache
+
+import tiktoken
+from langchain_core.messages import SystemMessage, HumanMessage
+from psycopg.rows import dict_row
+
+from back.metrics import llm_seconds
+from back.pool import get_pool
+
+log = logging.getLogger(__name__)
+
+# tokens added per message by the chat format
+MESSAGE_OVERHEAD = 4
+
+with open('back/summary_prompt.md', encoding='utf-8') as f:
+    summary_template = f.read()
+
+
+def create_tables(connection):
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_summary (
+            session_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            covered INTEGER NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """
+    )
+    connection.commit()
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    # o200k - tokenizer of the gpt-4o / gpt-4.1 models
+    return tiktoken.get_encoding('o200k_base')
+
+
+@lru_cache(maxsize=4096)
+def count_text_tokens(text: str) -> int:
+    return len(_encoding().encode(text))
+
+
+def count_tokens(messages) -> int:
+    return sum(count_text_tokens(m.content if isinstance(m.content, str) else str(m.content)) + MESSAGE_OVERHEAD
+               for m in messages)
+
+
+def load_summary(session_id: int):
+    """Return (summary, number of history messages it covers), (None, 0) if there is none."""
+    with get_pool().connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute("SELECT summary, covered FROM chat_summary WHERE session_id = %s", (session_id,))
+            row = cur.fetchone()
+    return (row['summary'], row['covered']) if row else (None, 0)
+
+
+def save_summary(session_id: int, summary: str, covered: int):
+    with get_pool().connection() as conn:
+        conn.execute(
+            "INSERT INTO chat_summary (session_id, summary, covered) VALUES (%s, %s, %s) "
+            "ON CONFLICT (session_id) DO UPDATE SET summary = EXCLUDED.summary, covered = EXCLUDED.covered, "
+            "updated_at = NOW()",
+            (session_id, summary, covered))
+
+
+def _transcript(messages) -> str:
+    roles = {'human': 'Кандидат', 'ai': 'Интервьюер', 'system': 'Инструкция'}
+    return '\n'.join(f"{roles.get(m.type, m.type)}: {m.content}" for m in messages)
+
+
+class ContextBudget:
+    """Fits the conversation part of the prompt into `budget` tokens.
+
+    The first message (the interview start instruction) and at least the last
+    `keep_turns` candidate/interviewer turns are always sent verbatim.
+    """
+
+    def __init__(self, model, budget: int, keep_turns: int = 6):
+        self.model = model
+        self.budget = budget
+        self.keep_messages = 2 * keep_turns + 1
+
+    def fit(self, session_id: int, fixed, messages):
+        """Return (messages to send, prompt stats) for the conversation `messages`.
+
+        fixed - the other messages of the prompt (system prompt etc), counted against the budget.
+        """
+        fixed_tokens = count_tokens(fixed)
+        full_tokens = fixed_tokens + count_tokens(messages)
+        head, body = messages[:1], messages[1:]
+        summary, covered = load_summary(session_id) if full_tokens > self.budget else (None, 0)
+        if covered > len(body):
+            # history was cleared
+            summary, covered = None, 0
+        recent = body[covered:]
+
+        def assemble():
+            summary_messages = [SystemMessage(content=f"Краткое содержание предыдущей части интервью:\n{summary}")] if summary else []
+            return head + summary_messages + recent
+
+        result = assemble()
+        tokens = fixed_tokens + count_tokens(result)
+        if tokens > self.budget and len(recent) > self.keep_messages:
+            tail = self._tail_length(recent, self.budget - fixed_tokens)
+            aged = recent[:len(recent) - tail]
+            if not aged:
+                # the summary itself pushes the prompt over the budget, rewriting it would not help
+                log.warning(f'Prompt of session {session_id} is over budget, nothing left to summarize')
+            elif fixed_tokens + count_tokens(head + recent[len(aged):]) >= self.budget:
+                # the fixed part and the kept turns alone do not fit, summarizing would run on every turn
+                log.warning(f'Prompt of session {session_id} is over budget without the summarized messages, '
+                            f'fixed part {fixed_tokens} tokens')
+            else:
+                summary = self.summarize(summary, aged)
+                covered += len(aged)
+                save_summary(session_id, summary, covered)
+                recent = body[covered:]
+                result = assemble()
+                tokens = fixed_tokens + count_tokens(result)
+        stats = {'prompt_tokens': tokens, 'full_tokens': full_tokens, 'summarized_messages': covered}
+        log.info(f'Prompt - {tokens} tokens (full history {full_tokens}, summarized {covered} messages)')
+        return result, stats
+
+    def _tail_length(self, recent, available: int) -> int:
+        """Number of last messages kept verbatim after summarization.
+
+        The tail takes up to half of the available tokens (but at least keep_messages),
+        the other half is headroom so the summary is not updated on every turn.
+        """
+        kept, tokens = 0, 0
+        for message in reversed(recent):
+            tokens += count_tokens([message])
+            if kept >= self.keep_messages and tokens > available // 2:
+                break
+            kept += 1
+        return kept
+
+    def summarize(self, summary, messages) -> str:
+        parts = []
+        if summary:
+            parts.append(f"Краткое содержание предыдущей части интервью:\n{summary}")
+        parts.append(f"Новые сообщения:\n{_transcript(messages)}")
+        with llm_seconds.time(call='summary'):
+            response = self.model.invoke([SystemMessage(content=summary_template), HumanMessage(content='\n\n'.join(parts))])
+        log.info(f'Summarized {len(messages)} messages')
+        return response.content
@@ -7,14 +7,20 @@ from __future__ import annotations
 import json
 import logging
 import re
+import threading
+import time
 import uuid
-from typing import List, Optional, Sequence
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, ContextManager, List, Optional, Sequence, Tuple
 
 import psycopg
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
 from psycopg import sql
 
+from back.metrics import chat_history_seconds, errors
+
 logger = logging.getLogger(__name__)
 
 
@@ -53,6 +59,27 @@ def _get_messages_query(table_name: str) -> sql.Composed:
     ).format(table_name=sql.Identifier(table_name))
 
 
+def _get_messages_since_query(table_name: str) -> sql.Composed:
+    """Make a SQL query to get messages of a session added after the given id."""
+    return sql.SQL(
+        "SELECT id, message "
+        "FROM {table_name} "
+        "WHERE session_id = %(session_id)s AND id > %(last_id)s "
+        "ORDER BY id;"
+    ).format(table_name=sql.Identifier(table_name))
+
+
+def _get_messages_between_query(table_name: str) -> sql.Composed:
+    """Make a SQL query to get messages of a session in an id range, except the given ids."""
+    return sql.SQL(
+        "SELECT id, message "
+        "FROM {table_name} "
+        "WHERE session_id = %(session_id)s AND id > %(last_id)s AND id <= %(until_id)s "
+        "AND NOT id = ANY(%(ids)s) "
+        "ORDER BY id;"
+    ).format(table_name=sql.Identifier(table_name))
+
+
 def _delete_by_session_id_query(table_name: str) -> sql.Composed:
     """Make a SQL query to delete messages for a given session."""
     return sql.SQL(
@@ -70,10 +97,266 @@ def _delete_table_query(table_name: str) -> sql.Composed:
 def _insert_message_query(table_name: str) -> sql.Composed:
     """Make a SQL query to insert a message."""
     return sql.SQL(
-        "INSERT INTO {table_name} (session_id, message) VALUES (%s, %s)"
+        "INSERT INTO {table_name} (session_id, message) VALUES (%s, %s) RETURNING id"
     ).format(table_name=sql.Identifier(table_name))
 
 
+def _copy_messages_query(table_name: str) -> sql.Composed:
+    """Make a SQL query to bulk load messages."""
+    return sql.SQL("COPY {table_name} (session_id, message) FROM STDIN").format(
+        table_name=sql.Identifier(table_name)
+    )
+
+
+def _fetch_returned_ids(cursor: psycopg.Cursor) -> List[int]:
+    """Collect ids returned by executemany(..., returning=True), one result per row."""
+    ids = []
+    while True:
+        ids.append(cursor.fetchone()[0])
+        if not cursor.nextset():
+            break
+    return ids
+
+
+async def _afetch_returned_ids(cursor: psycopg.AsyncCursor) -> List[int]:
+    ids = []
+    while True:
+        ids.append((await cursor.fetchone())[0])
+        if not cursor.nextset():
+            break
+    return ids
+
+
+class HistoryCache:
+    """In-process LRU cache of deserialized messages per session.
+
+    Every entry remembers the id of the last row it contains (the watermark), so
+    a cached history is brought up to date by reading only the rows with a
+    greater id. At most `max_sessions` histories are kept.
+
+    Messages written through the cached history are appended locally, together
+    with the rows another process added to the session since the watermark.
+    """
+
+    def __init__(self, max_sessions: int = 256) -> None:
+        self._max_sessions = max_sessions
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[Tuple[int, List[BaseMessage]]]:
+        """Return (watermark, messages) of the session, None if not cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0], list(entry[1])
+
+    def extend(
+        self, key, since: int, last_id: int, messages: Sequence[BaseMessage]
+    ) -> None:
+        """Append messages with ids in (since, last_id] to the cached history.
+
+        Entries which moved past `since` in the meantime are left untouched, a
+        session that is not cached is only created when reading from scratch.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if since != 0:
+                    return
+                entry = self._entries[key] = [0, []]
+            elif entry[0] != since:
+                return
+            entry[0] = last_id
+            entry[1].extend(messages)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_sessions:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "messages": sum(len(e[1]) for e in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class _ReadWriteLock:
+    """Shared / exclusive lock for a single exclusive holder, new readers wait for it."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._writing = True
+            while self._readers:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class HistoryWriter:
+    """Background writer of chat history rows.
+
+    Added messages are queued and a single thread writes them with COPY, many
+    sessions per transaction, in the order they were added. Until their
+    transaction commits the messages are pending: reads of the session return
+    them after the stored rows, so the conversation is complete without waiting
+    for the write. Commits and reads exclude each other, a read sees every
+    message either stored or pending, never both.
+
+    Pending messages are only visible in this process, before a session may be
+    read by another process (its next update or evaluation) wait() for them.
+    A failed batch is retried with backoff until it is written or the writer
+    is stopped.
+    """
+
+    def __init__(
+        self,
+        connection_factory: Callable[[], ContextManager[psycopg.Connection]],
+        max_batch: int = 500,
+    ) -> None:
+        self._connect = connection_factory
+        self._max_batch = max_batch
+        self._cond = threading.Condition()
+        self._queue: deque = deque()  # (key, messages) in the order of submission
+        self._pending: dict = {}  # key -> messages not committed yet
+        self._rw = _ReadWriteLock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def submit(self, key: Tuple[str, int], messages: Sequence[BaseMessage]) -> None:
+        """Queue messages of the (table_name, session_id) history, returns immediately."""
+        messages = list(messages)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("History writer is stopped")
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="history-writer", daemon=True
+                )
+                self._thread.start()
+            self._queue.append((key, messages))
+            self._pending.setdefault(key, []).extend(messages)
+            self._cond.notify_all()
+
+    @contextmanager
+    def reading(self, key: Tuple[str, int]):
+        """Hold off commits while the history is read, yields its pending messages."""
+        with self._rw.shared():
+            with self._cond:
+                pending = list(self._pending.get(key, ()))
+            yield pending
+
+    def wait(self, key: Optional[Tuple[str, int]] = None, timeout: Optional[float] = None) -> bool:
+        """Wait until the messages of the history (all if key is None) are written."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not (self._pending if key is None else key in self._pending),
+                timeout,
+            )
+
+    def qsize(self) -> int:
+        """Number of messages not written yet."""
+        with self._cond:
+            return sum(len(messages) for messages in self._pending.values())
+
+    def stop(self, timeout: Optional[float] = 30) -> None:
+        """Write what is queued and stop the thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        delay = 0.5
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._stopped)
+                if not self._queue:
+                    return
+                batch = [self._queue[i] for i in range(min(self._max_batch, len(self._queue)))]
+            try:
+                self._write(batch)
+                delay = 0.5
+            except Exception as e:
+                errors.inc(operation="chat_history_write")
+                with self._cond:
+                    stopped = self._stopped
+                if stopped:
+                    logger.error(
+                        f"Dropped {sum(len(m) for _, m in batch)} chat history messages: {str(e)}"
+                    )
+                    self._done(batch)
+                    continue
+                logger.error(f"Chat history write failed, retrying in {delay}s: {str(e)}")
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    def _write(self, batch) -> None:
+        rows: dict = {}
+        for (table_name, session_id), messages in batch:
+            rows.setdefault(table_name, []).extend(
+                (session_id, json.dumps(message_to_dict(message))) for message in messages
+            )
+        with self._connect() as conn:
+            with chat_history_seconds.time(operation="copy"):
+                with conn.cursor() as cursor:
+                    for table_name, table_rows in rows.items():
+                        with cursor.copy(_copy_messages_query(table_name)) as copy:
+                            for row in table_rows:
+                                copy.write_row(row)
+                with self._rw.exclusive():
+                    conn.commit()
+                    self._done(batch)
+
+    def _done(self, batch) -> None:
+        with self._cond:
+            for _ in batch:
+                key, messages = self._queue.popleft()
+                rest = self._pending[key][len(messages):]
+                if rest:
+                    self._pending[key] = rest
+                else:
+                    del self._pending[key]
+            self._cond.notify_all()
+
+
 class PostgresChatMessageHistory(BaseChatMessageHistory):
     def __init__(
         self,
@@ -83,6 +366,8 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
         *,
         sync_connection: Optional[psycopg.Connection] = None,
         async_connection: Optional[psycopg.AsyncConnection] = None,
+        cache: Optional[HistoryCache] = None,
+        writer: Optional[HistoryWriter] = None,
     ) -> None:
         """Client for persisting chat message history in a Postgres database,
 
@@ -132,6 +417,10 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
             table_name: The name of the database table to use
             sync_connection: An existing psycopg connection instance
             async_connection: An existing psycopg async connection instance
+            cache: Optional HistoryCache shared between instances, when given
+                only the messages added since the last read are fetched
+            writer: Optional HistoryWriter, when given added messages are written
+                in the background and add_messages does not wait for the database
 
         Usage:
             - Use the create_tables or acreate_tables method to set up the table
@@ -201,6 +490,12 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
                 "characters and underscores."
             )
         self._table_name = table_name
+        self._cache = cache
+        self._writer = writer
+
+    @property
+    def _cache_key(self) -> Tuple[str, int]:
+        return self._table_name, self._session_id
 
     @staticmethod
     def create_tables(
@@ -276,6 +571,13 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
                 "with a sync connection or use the aadd_messages method instead."
             )
 
+        if not messages:
+            return
+
+        if self._writer is not None:
+            self._writer.submit(self._cache_key, messages)
+            return
+
         values = [
             (self._session_id, json.dumps(message_to_dict(message)))
             for message in messages
@@ -283,9 +585,17 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
 
         query = _insert_message_query(self._table_name)
 
-        with self._connection.cursor() as cursor:
-            cursor.executemany(query, values)
-        self._connection.commit()
+        with chat_history_seconds.time(operation='add'):
+            with self._connection.cursor() as cursor:
+                cursor.executemany(query, values, returning=True)
+                ids = _fetch_returned_ids(cursor)
+            self._connection.commit()
+        last_id = self._cache_watermark(ids)
+        if last_id is not None:
+            with self._connection.cursor() as cursor:
+                cursor.execute(_get_messages_between_query(self._table_name), self._between_params(last_id, ids))
+                records = cursor.fetchall()
+            self._cache_added(last_id, messages, ids, records)
 
     async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
         """Add messages to the chat message history."""
@@ -295,15 +605,56 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
                 "with an async connection or use the sync add_messages method instead."
             )
 
+        if not messages:
+            return
+
+        if self._writer is not None:
+            self._writer.submit(self._cache_key, messages)
+            return
+
         values = [
             (self._session_id, json.dumps(message_to_dict(message)))
             for message in messages
         ]
 
         query = _insert_message_query(self._table_name)
-        async with self._aconnection.cursor() as cursor:
-            await cursor.executemany(query, values)
-        await self._aconnection.commit()
+        with chat_history_seconds.time(operation='add'):
+            async with self._aconnection.cursor() as cursor:
+                await cursor.executemany(query, values, returning=True)
+                ids = await _afetch_returned_ids(cursor)
+            await self._aconnection.commit()
+        last_id = self._cache_watermark(ids)
+        if last_id is not None:
+            async with self._aconnection.cursor() as cursor:
+                await cursor.execute(_get_messages_between_query(self._table_name),
+                                     self._between_params(last_id, ids))
+                records = await cursor.fetchall()
+            self._cache_added(last_id, messages, ids, records)
+
+    def _cache_watermark(self, ids: List[int]) -> Optional[int]:
+        """Watermark of the cached history the just written rows are appended to, None if not cached."""
+        if self._cache is None or not ids:
+            return None
+        cached = self._cache.get(self._cache_key)
+        if cached is None or cached[0] >= ids[0]:
+            return None
+        return cached[0]
+
+    def _between_params(self, last_id: int, ids: List[int]) -> dict:
+        return {"session_id": self._session_id, "last_id": last_id, "until_id": ids[-1], "ids": ids}
+
+    def _cache_added(
+        self, last_id: int, messages: Sequence[BaseMessage], ids: List[int], records: Sequence[tuple]
+    ) -> None:
+        """Append just written messages and the rows other processes added since the watermark to the cache."""
+        if records:
+            rows = sorted(
+                [*zip(ids, messages), *zip([record[0] for record in records],
+                                           messages_from_dict([record[1] for record in records]))],
+                key=lambda row: row[0],
+            )
+            messages = [message for _, message in rows]
+        self._cache.extend(self._cache_key, last_id, ids[-1], messages)
 
     def get_messages(self) -> List[BaseMessage]:
         """Retrieve messages from the chat message history."""
@@ -313,11 +664,29 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
                 "with a sync connection or use the async aget_messages method instead."
             )
 
+        if self._writer is None:
+            return self._read_messages()
+        with self._writer.reading(self._cache_key) as pending:
+            return self._read_messages() + pending
+
+    def _read_messages(self) -> List[BaseMessage]:
+        if self._cache is not None:
+            last_id, messages = self._cache.get(self._cache_key) or (0, [])
+            query = _get_messages_since_query(self._table_name)
+            with chat_history_seconds.time(operation='get'):
+                with self._connection.cursor() as cursor:
+                    cursor.execute(
+                        query, {"session_id": self._session_id, "last_id": last_id}
+                    )
+                    records = cursor.fetchall()
+            return self._cache_fetched(last_id, messages, records)
+
         query = _get_messages_query(self._table_name)
 
-        with self._connection.cursor() as cursor:
-            cursor.execute(query, {"session_id": self._session_id})
-            items = [record[0] for record in cursor.fetchall()]
+        with chat_history_seconds.time(operation='get'):
+            with self._connection.cursor() as cursor:
+                cursor.execute(query, {"session_id": self._session_id})
+                items = [record[0] for record in cursor.fetchall()]
 
         messages = messages_from_dict(items)
         return messages
@@ -330,14 +699,42 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
                 "with an async connection or use the sync get_messages method instead."
             )
 
+        if self._writer is None:
+            return await self._aread_messages()
+        # commits of the writer are short, holding them off does not need to be async
+        with self._writer.reading(self._cache_key) as pending:
+            return await self._aread_messages() + pending
+
+    async def _aread_messages(self) -> List[BaseMessage]:
+        if self._cache is not None:
+            last_id, messages = self._cache.get(self._cache_key) or (0, [])
+            query = _get_messages_since_query(self._table_name)
+            with chat_history_seconds.time(operation='get'):
+                async with self._aconnection.cursor() as cursor:
+                    await cursor.execute(
+                        query, {"session_id": self._session_id, "last_id": last_id}
+                    )
+                    records = await cursor.fetchall()
+            return self._cache_fetched(last_id, messages, records)
+
         query = _get_messages_query(self._table_name)
-        async with self._aconnection.cursor() as cursor:
-            await cursor.execute(query, {"session_id": self._session_id})
-            items = [record[0] for record in await cursor.fetchall()]
+        with chat_history_seconds.time(operation='get'):
+            async with self._aconnection.cursor() as cursor:
+                await cursor.execute(query, {"session_id": self._session_id})
+                items = [record[0] for record in await cursor.fetchall()]
 
         messages = messages_from_dict(items)
         return messages
 
+    def _cache_fetched(
+        self, last_id: int, messages: List[BaseMessage], records: Sequence[tuple]
+    ) -> List[BaseMessage]:
+        """Decode rows read after the watermark and add them to the cache."""
+        new_messages = messages_from_dict([record[1] for record in records])
+        new_last_id = records[-1][0] if records else last_id
+        self._cache.extend(self._cache_key, last_id, new_last_id, new_messages)
+        return messages + new_messages
+
     @property  # type: ignore[override]
     def messages(self) -> List[BaseMessage]:
         """The abstraction required a property."""
@@ -351,10 +748,16 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
                 "with a sync connection or use the async clear method instead."
             )
 
+        if self._writer is not None:
+            self._writer.wait(self._cache_key)
+
         query = _delete_by_session_id_query(self._table_name)
-        with self._connection.cursor() as cursor:
-            cursor.execute(query, {"session_id": self._session_id})
-        self._connection.commit()
+        with chat_history_seconds.time(operation='clear'):
+            with self._connection.cursor() as cursor:
+                cursor.execute(query, {"session_id": self._session_id})
+            self._connection.commit()
+        if self._cache is not None:
+            self._cache.invalidate(self._cache_key)
 
     async def aclear(self) -> None:
         """Clear the chat message history for the GIVEN session."""
@@ -364,7 +767,13 @@ class PostgresChatMessageHistory(BaseChatMessageHistory):
                 "with an async connection or use the sync clear method instead."
             )
 
+        if self._writer is not None:
+            self._writer.wait(self._cache_key)
+
         query = _delete_by_session_id_query(self._table_name)
-        async with self._aconnection.cursor() as cursor:
-            await cursor.execute(query, {"session_id": self._session_id})
-        await self._aconnection.commit()
+        with chat_history_seconds.time(operation='clear'):
+            async with self._aconnection.cursor() as cursor:
+                await cursor.execute(query, {"session_id": self._session_id})
+            await self._aconnection.commit()
+        if self._cache is not None:
+            self._cache.invalidate(self._cache_key)
@@ -1,26 +1,34 @@
+import logging
 import os
 
-import psycopg
 from fastapi import HTTPException
 
+from back import chat_state, context, jobs, resume, writes
+from back.cache import ttl_cache
 from back.custom_postgres import PostgresChatMessageHistory
+from back.metrics import observe_db
+from back.retry import retry, is_transient_not_applied
 
-from config import SUPABASE_URL, SUPABASE_KEY, conn_info
-from retry import retry
+from back.pool import get_pool
+from psycopg import sql
+from config import SUPABASE_URL, SUPABASE_KEY
 from typing import Optional
 from supabase import create_client
 
+log = logging.getLogger(__name__)
+
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 TTL = 600
-TRIES = 3
-DELAY = 2
-BACKOFF = 2
+CACHE_SIZE = 256
+HISTORY_PAGE_SIZE = 30
+CANDIDATES_PAGE_SIZE = 50
 
 table_name = 'chat_history'
 
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def get_all_vacancies():
     response = supabase.table("current_sessions").select("*").execute()
     if response:
@@ -29,22 +37,137 @@ def get_all_vacancies():
         raise HTTPException(status_code=500, detail="Failed to retrieve vacancies")
 
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
-def get_candidates_by_vacancy(vacancy_id: int):
-    response = (
-        supabase.table("session")
-        .select("chat:chat_id (id, name, email), state")
-        .eq("vacancy_id", vacancy_id)
-        .execute()
-    )
-    if response:
-        return response.data
-    else:
-        raise HTTPException(status_code=500, detail="Failed to retrieve candidates")
-    # Extract the 'chat' data from the response
-
-
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+def create_candidate_tables(connection):
+    """Score table and indexes behind adb.list_candidates.
+
+    Scores of the sessions evaluated before the table existed are backfilled from
+    latest_marks once, when the table is created, later ones are stored by update_session_score.
+    """
+    created = connection.execute("SELECT to_regclass('session_scores') IS NULL").fetchone()[0]
+    statements = [
+        """
+        CREATE TABLE IF NOT EXISTS session_scores (
+            session_id INTEGER PRIMARY KEY,
+            vacancy_id INTEGER NOT NULL,
+            score DOUBLE PRECISION NOT NULL,
+            min_mark INTEGER NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_session_scores_vacancy_score ON session_scores (vacancy_id, score DESC, session_id DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_session_vacancy_id ON session (vacancy_id, id DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_session_vacancy_state_id ON session (vacancy_id, state, id DESC);",
+    ]
+    if created:
+        statements.append(
+            """
+            INSERT INTO session_scores (session_id, vacancy_id, score, min_mark)
+            SELECT s.id, s.vacancy_id, avg(m.value), min(m.value)
+            FROM session s JOIN latest_marks m ON m.chat_id = s.chat_id AND m.vacancy_id = s.vacancy_id
+            GROUP BY s.id, s.vacancy_id
+            ON CONFLICT (session_id) DO NOTHING;
+            """)
+    for statement in statements:
+        connection.execute(statement)
+    connection.commit()
+
+
+_SCORE_QUERY = (
+    "INSERT INTO session_scores (session_id, vacancy_id, score, min_mark) VALUES (%s, %s, %s, %s) "
+    "ON CONFLICT (session_id) DO UPDATE SET score = EXCLUDED.score, min_mark = EXCLUDED.min_mark, updated_at = NOW()"
+)
+
+
+def update_session_score(session_id: int, vacancy_id: int, marks):
+    """Store the aggregate of the session marks (by requirement id) used to sort and filter candidates."""
+    values = list(marks.values())
+    with get_pool().connection() as conn:
+        conn.execute(_SCORE_QUERY, (session_id, vacancy_id, sum(values) / len(values), min(values)))
+
+
+_CANDIDATE_COLUMNS = "s.id AS session_id, s.state, c.id AS chat_id, c.name, c.email, sc.score, sc.min_mark"
+# cursor of the last session without a score, they follow the scored ones when sorted by score
+_UNSCORED = 'null'
+
+
+def candidates_queries(vacancy_id, sort, state, min_score, max_score, min_mark, cursor):
+    """Queries and parameters of a page of adb.list_candidates in order, the row limit is passed as %(limit)s.
+
+    Sorted by score, the scored sessions are read in the order of idx_session_scores_vacancy_score
+    and the sessions without a score after them, so a page does not sort all sessions of the vacancy.
+    """
+    if sort not in ('score', 'date'):
+        raise HTTPException(status_code=400, detail=f"Unknown sort {sort}")
+    params = {'vacancy_id': vacancy_id, 'state': state, 'min_score': min_score, 'max_score': max_score,
+              'min_mark': min_mark}
+    after_score = None
+    if cursor:
+        try:
+            if sort == 'score':
+                after_score, after_id = cursor.split(':')
+                if after_score != _UNSCORED:
+                    params['after_score'] = float(after_score)
+                params['after_id'] = int(after_id)
+            else:
+                params['after_id'] = int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    filters = []
+    if state is not None:
+        filters.append("s.state = %(state)s")
+    if min_score is not None:
+        filters.append("sc.score >= %(min_score)s")
+    if max_score is not None:
+        filters.append("sc.score <= %(max_score)s")
+    if min_mark is not None:
+        filters.append("sc.min_mark >= %(min_mark)s")
+
+    if sort == 'date':
+        conditions = ["s.vacancy_id = %(vacancy_id)s", *filters]
+        if cursor:
+            conditions.append("s.id < %(after_id)s")
+        return [(
+            f"SELECT {_CANDIDATE_COLUMNS} FROM session s JOIN chat c ON c.id = s.chat_id "
+            "LEFT JOIN session_scores sc ON sc.session_id = s.id "
+            f"WHERE {' AND '.join(conditions)} ORDER BY s.id DESC LIMIT %(limit)s", params)]
+
+    queries = []
+    if after_score != _UNSCORED:
+        conditions = ["sc.vacancy_id = %(vacancy_id)s", *filters]
+        if cursor:
+            conditions.append("(sc.score, sc.session_id) < (%(after_score)s, %(after_id)s)")
+        queries.append((
+            f"SELECT {_CANDIDATE_COLUMNS} FROM session_scores sc JOIN session s ON s.id = sc.session_id "
+            "JOIN chat c ON c.id = s.chat_id "
+            f"WHERE {' AND '.join(conditions)} ORDER BY sc.score DESC, sc.session_id DESC LIMIT %(limit)s",
+            params))
+    if min_score is None and max_score is None and min_mark is None:
+        # the score filters exclude sessions without a score
+        conditions = ["s.vacancy_id = %(vacancy_id)s", "sc.session_id IS NULL", *filters]
+        if after_score == _UNSCORED:
+            conditions.append("s.id < %(after_id)s")
+        queries.append((
+            f"SELECT {_CANDIDATE_COLUMNS} FROM session s JOIN chat c ON c.id = s.chat_id "
+            "LEFT JOIN session_scores sc ON sc.session_id = s.id "
+            f"WHERE {' AND '.join(conditions)} ORDER BY s.id DESC LIMIT %(limit)s", params))
+    return queries
+
+
+def candidates_page(rows, sort, limit):
+    """Page of the rows read with a limit of one more row, returns (rows, next cursor or None)."""
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if sort == 'score':
+            next_cursor = f"{last['score'] if last['score'] is not None else _UNSCORED}:{last['session_id']}"
+        else:
+            next_cursor = str(last['session_id'])
+    return rows, next_cursor
+
+
+@retry(breaker='supabase')
+@observe_db
 def get_all_candidates():
     response = (supabase.table("chat")
                 .select("id, name, email, session:session_id(state)")
@@ -56,38 +179,20 @@ def get_all_candidates():
         raise HTTPException(status_code=500, detail="Failed to retrieve candidates")
 
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
-def get_candidate_details(chat_id: int, vacancy_id: int):
-    # Fetch candidate information
-    candidate_response = supabase.table("chat").select("*").eq("id", chat_id).single().execute()
-    if candidate_response:
-        candidate = candidate_response.data
-    else:
-        raise HTTPException(status_code=500, detail="Failed to retrieve candidates details")
-
-
-    # Fetch marks
-    #marks_response = supabase.table("marks").select("*, requirements:requirement_id(name)").eq("chat_id", candidate_id).execute()
-    marks_response = supabase.table("latest_marks").select("*, marks:requirement_id(vacancy_id)").eq("chat_id", chat_id).eq("vacancy_id", vacancy_id).execute()
-    if marks_response:
-        marks = marks_response.data
-    else:
-        raise HTTPException(status_code=500, detail="Failed to retrieve marks")
-
-
-    # Fetch chat history
-    session_id = get_session(chat_id, vacancy_id)['id']
-    chat_history_response = supabase.table("chat_history").select("*").eq("session_id", session_id).order('id').execute()
-    if chat_history_response:
-        chat_history = chat_history_response.data
-    else:
-        raise HTTPException(status_code=500, detail="Failed to retrieve message history")
-
+def history_page_query():
+    """Page of the candidate's messages for the vacancy, newest first, with id < before_id."""
+    return sql.SQL(
+        "SELECT h.id, h.message, h.created_at FROM {table_name} h "
+        "JOIN session s ON s.id = h.session_id "
+        "WHERE s.chat_id = %(chat_id)s AND s.vacancy_id = %(vacancy_id)s "
+        "AND (%(before_id)s::integer IS NULL OR h.id < %(before_id)s::integer) "
+        "ORDER BY h.id DESC LIMIT %(limit)s"
+    ).format(table_name=sql.Identifier(table_name))
 
-    return candidate, marks, chat_history
 
-#@st.cache_resource(ttl=TTL)
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@ttl_cache(ttl=TTL, maxsize=CACHE_SIZE)
+@retry(breaker='supabase')
+@observe_db
 def get_vacancy(vacancy_id):
     v = (supabase.table('vacancies')
          .select('*')
@@ -100,7 +205,9 @@ def get_vacancy(vacancy_id):
 
 
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@ttl_cache(ttl=TTL, maxsize=1)
+@retry(breaker='supabase')
+@observe_db
 def get_opened_vacancies():
     v = (supabase.table('vacancies')
          .select('id','name')
@@ -108,7 +215,8 @@ def get_opened_vacancies():
     if v:
         return v.data
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def get_vacancy_id(vacancy_name):
     v = (supabase.table('vacancies')
          .select('id')
@@ -118,7 +226,9 @@ def get_vacancy_id(vacancy_name):
     if v:
         return v.data
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@ttl_cache(ttl=TTL, maxsize=1)
+@retry(breaker='supabase')
+@observe_db
 def get_requirements_ids():
     v = (supabase.table('requirements')
          .select('id', 'name', 'vacancy_id')
@@ -126,14 +236,58 @@ def get_requirements_ids():
     if v:
         return v.data
 
-def transform_marks(marks_dict, reqs_dict, vacancy_id):
-    name_to_id = {item['name']: item['id'] for item in reqs_dict if item['vacancy_id'] == vacancy_id}
-    transformed_dict = {name_to_id[key]: value for key, value in marks_dict.items() if key in name_to_id}
-    return transformed_dict
-
-
-#@st.cache_resource(ttl=TTL)
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+def invalidate_vacancy(vacancy_id: int):
+    """Drop cached data of the vacancy, call after the vacancy or its requirements were changed."""
+    get_vacancy.invalidate(vacancy_id)
+    get_requirements.invalidate(vacancy_id)
+    get_requirement_index.invalidate(vacancy_id)
+    get_opened_vacancies.cache_clear()
+    get_requirements_ids.cache_clear()
+
+class RequirementIndex:
+    """Requirement name -> id mapping of one vacancy."""
+
+    def __init__(self, vacancy_id: int, requirements):
+        self.vacancy_id = vacancy_id
+        self.ids = {r['name']: r['id'] for r in requirements}
+
+    def resolve(self, marks_dict):
+        """Map marks by requirement name to marks by requirement id.
+
+        Returns (marks by id, names which match no requirement of the vacancy).
+        """
+        transformed, unknown = {}, []
+        for name, value in marks_dict.items():
+            requirement_id = self.ids.get(name)
+            if requirement_id is None:
+                unknown.append(name)
+            else:
+                transformed[requirement_id] = value
+        return transformed, unknown
+
+
+@ttl_cache(ttl=TTL, maxsize=CACHE_SIZE)
+def get_requirement_index(vacancy_id: int) -> RequirementIndex:
+    return RequirementIndex(vacancy_id, get_requirements(vacancy_id))
+
+
+def transform_marks(marks_dict, vacancy_id):
+    """Convert marks keyed by requirement name (LLM tool call arguments) to marks keyed by requirement id."""
+    transformed, unknown = get_requirement_index(vacancy_id).resolve(marks_dict)
+    if unknown:
+        # requirements may have changed since the index was loaded, reload it once; the other
+        # caches of invalidate_vacancy are kept, the model often just misnames a requirement
+        get_requirements.invalidate(vacancy_id)
+        get_requirement_index.invalidate(vacancy_id)
+        transformed, unknown = get_requirement_index(vacancy_id).resolve(marks_dict)
+    if unknown:
+        log.warning(f'Marks for unknown requirements of vacancy {vacancy_id}: {unknown}')
+    return transformed
+
+
+@ttl_cache(ttl=TTL, maxsize=CACHE_SIZE)
+@retry(breaker='supabase')
+@observe_db
 def get_requirements(vacancy_id: int):
     v = (supabase.table('requirements')
          .select('*')
@@ -141,7 +295,8 @@ def get_requirements(vacancy_id: int):
          .execute())
     return v.data
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def get_session_state(chat_id):
     state = (supabase.table('chat')
             .select("session:session_id(state)")
@@ -152,7 +307,8 @@ def get_session_state(chat_id):
         return state.data['session']['state']
 
 #@st.cache_resource(ttl=TTL)
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def get_candidate(email: str):
     cand = (supabase.table('candidates')
             .select("id,name,resume")
@@ -163,7 +319,8 @@ def get_candidate(email: str):
     if cand:
         return cand.data
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def get_chat(chat_id: int):
     cand = (supabase.table('chat')
             .select("*")
@@ -173,7 +330,8 @@ def get_chat(chat_id: int):
     if cand:
         return cand.data
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def get_marks(chat_id: int, vacancy_id: int):
     marks = (supabase.table('marks')
             .select("*")
@@ -183,7 +341,8 @@ def get_marks(chat_id: int, vacancy_id: int):
     if marks:
         return marks.data
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def get_session(chat_id: int, vacancy_id: int):
     sesh = (supabase.table('session')
             .select("*")
@@ -195,7 +354,8 @@ def get_session(chat_id: int, vacancy_id: int):
         return sesh.data
 
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def get_session_by_id(session_id: int):
     sesh = (supabase.table('session')
             .select("*")
@@ -205,7 +365,18 @@ def get_session_by_id(session_id: int):
     if sesh:
         return sesh.data
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
+def get_finished_session_ids(vacancy_id: int):
+    sessions = (supabase.table('session')
+                .select("id")
+                .eq('vacancy_id', vacancy_id)
+                .eq('state', 'finished')
+                .execute())
+    return [s['id'] for s in sessions.data]
+
+@retry(breaker='supabase')
+@observe_db
 def get_candidate_by_id(id: int):
     cand = (supabase.table('chat')
             .select("*")
@@ -216,7 +387,8 @@ def get_candidate_by_id(id: int):
     if cand:
         return cand.data
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def upsert_session(chat_id, vacancy_id, state, cost: Optional[float] = None):
     data = {
         'chat_id': chat_id,
@@ -229,11 +401,14 @@ def upsert_session(chat_id, vacancy_id, state, cost: Optional[float] = None):
      .upsert(data, on_conflict='chat_id, vacancy_id')
      .execute())
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+# increment_cost is not idempotent, a call which may have been applied is not repeated
+@retry(breaker='supabase', transient=is_transient_not_applied)
+@observe_db
 def update_cost(session_id, value):
     supabase.rpc('increment_cost', {'x': value, 'sesh_id': session_id }).execute()
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def update_marks(cand_id, marks):
     (supabase.table('marks')
      .upsert([dict(
@@ -245,7 +420,8 @@ def update_marks(cand_id, marks):
 
 
 
-@retry(tries=TRIES, delay=DELAY, backoff=BACKOFF)
+@retry(breaker='supabase')
+@observe_db
 def update_chat_info(chat_id, name: Optional[str]=None, email: Optional[str]=None, new_resume: Optional[str] = None, session_id: Optional[int] = None):
     data = {
         'id': chat_id
@@ -263,10 +439,16 @@ def update_chat_info(chat_id, name: Optional[str]=None, email: Optional[str]=Non
 
 def init_db():
     global table_name
-    with psycopg.connect(conn_info, prepare_threshold=None) as conn:
+    with get_pool().connection() as conn:
         try:
             sync_connection = conn
             print("Connected to the database")
         except Exception as e:
             print(f"Unable to connect to the database: {e}")
         PostgresChatMessageHistory.create_tables(sync_connection, table_name)
+        chat_state.create_tables(sync_connection)
+        jobs.create_tables(sync_connection)
+        create_candidate_tables(sync_connection)
+        resume.create_tables(sync_connection)
+        context.create_tables(sync_connection)
+        writes.create_tables(sync_connection)
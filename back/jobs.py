@@ -0,0 +1,226 @@
+"""Durable queue of interview evaluation jobs.
+
+Jobs are rows of the evaluation_jobs table keyed by session id, so they survive
+restarts and can be picked up by any process. Workers claim jobs with
+SELECT ... FOR UPDATE SKIP LOCKED, a failed job is retried with exponential
+backoff until EVAL_MAX_ATTEMPTS is reached. Every claim gets a new claim_id,
+a worker whose job was claimed again (it
+ran past EVAL_JOB_TIMEOUT) can not complete or fail it. A job queued again
+while it runs is run once more after the current run.
+"""
+import logging
+import threading
+
+from psycopg import sql
+
+from back.metrics import errors, retries
+from back.pool import get_pool
+from config import EVAL_MAX_ATTEMPTS, EVAL_RETRY_DELAY, EVAL_POLL_INTERVAL, EVAL_JOB_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+table_name = 'evaluation_jobs'
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# set when a job is queued by this process, wakes up idle local workers
+_wakeup = threading.Event()
+
+
+def create_tables(connection):
+    connection.execute(sql.SQL(
+        """
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            session_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            requeued BOOLEAN NOT NULL DEFAULT FALSE,
+            claim_id UUID,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """
+    ).format(table_name=sql.Identifier(table_name)))
+    connection.execute(sql.SQL(
+        "ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS requeued BOOLEAN NOT NULL DEFAULT FALSE, "
+        "ADD COLUMN IF NOT EXISTS claim_id UUID;"
+    ).format(table_name=sql.Identifier(table_name)))
+    connection.execute(sql.SQL(
+        "CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} (status, run_after);"
+    ).format(table_name=sql.Identifier(table_name), index_name=sql.Identifier(f'idx_{table_name}_status')))
+    connection.commit()
+
+
+def enqueue_evaluation(session_id: int):
+    """Queue (or re-queue) evaluation of the session.
+
+    A running job is not reset, it is marked to run again once the current run ends.
+    """
+    query = sql.SQL(
+        "INSERT INTO {table_name} AS j (session_id, status) VALUES (%(session_id)s, %(pending)s) "
+        "ON CONFLICT (session_id) DO UPDATE SET "
+        "status = CASE WHEN j.status = %(running)s THEN j.status ELSE EXCLUDED.status END, "
+        "requeued = j.status = %(running)s, "
+        "attempts = CASE WHEN j.status = %(running)s THEN j.attempts ELSE 0 END, "
+        "last_error = CASE WHEN j.status = %(running)s THEN j.last_error END, "
+        "run_after = NOW(), "
+        "updated_at = CASE WHEN j.status = %(running)s THEN j.updated_at ELSE NOW() END"
+    ).format(table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        conn.execute(query, {'session_id': session_id, 'pending': PENDING, 'running': RUNNING})
+    log.info(f'Evaluation of session {session_id} queued')
+    _wakeup.set()
+
+
+def claim_job():
+    """Mark the next due job as running, returns the claim (session id, claim id) or None if there is nothing to do.
+
+    Jobs left running longer than EVAL_JOB_TIMEOUT (crashed or hung worker) are claimed again,
+    or marked failed when they have used up EVAL_MAX_ATTEMPTS.
+    """
+    params = {'running': RUNNING, 'pending': PENDING, 'failed': FAILED, 'timeout': EVAL_JOB_TIMEOUT,
+              'max_attempts': EVAL_MAX_ATTEMPTS}
+    expire = sql.SQL(
+        "UPDATE {table_name} SET status = %(failed)s, last_error = 'Evaluation timed out', updated_at = NOW() "
+        "WHERE status = %(running)s AND updated_at < NOW() - make_interval(secs => %(timeout)s) "
+        "AND attempts >= %(max_attempts)s AND NOT requeued"
+    ).format(table_name=sql.Identifier(table_name))
+    claim = sql.SQL(
+        "UPDATE {table_name} SET status = %(running)s, "
+        "attempts = CASE WHEN requeued THEN 1 ELSE attempts + 1 END, requeued = FALSE, claim_id = gen_random_uuid(), "
+        "updated_at = NOW() "
+        "WHERE session_id = ("
+        "  SELECT session_id FROM {table_name} "
+        "  WHERE (status = %(pending)s AND run_after <= NOW()) "
+        "     OR (status = %(running)s AND updated_at < NOW() - make_interval(secs => %(timeout)s) "
+        "         AND (attempts < %(max_attempts)s OR requeued)) "
+        "  ORDER BY run_after LIMIT 1 FOR UPDATE SKIP LOCKED"
+        ") RETURNING session_id, claim_id"
+    ).format(table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        expired = conn.execute(expire, params).rowcount
+        if expired:
+            errors.inc(expired, operation='evaluation')
+            log.error(f'{expired} evaluation jobs timed out for good')
+        row = conn.execute(claim, params).fetchone()
+    return tuple(row) if row else None
+
+
+def complete_job(session_id: int, claim_id) -> bool:
+    """Mark the claimed job done, or pending if it was queued again meanwhile. False if the claim was lost."""
+    query = sql.SQL(
+        "UPDATE {table_name} SET status = CASE WHEN requeued THEN %(pending)s ELSE %(done)s END, "
+        "attempts = CASE WHEN requeued THEN 0 ELSE attempts END, requeued = FALSE, "
+        "last_error = NULL, run_after = NOW(), updated_at = NOW() "
+        "WHERE session_id = %(session_id)s AND status = %(running)s AND claim_id = %(claim_id)s"
+    ).format(table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        return conn.execute(query, {'pending': PENDING, 'done': DONE, 'running': RUNNING,
+                                    'session_id': session_id, 'claim_id': claim_id}).rowcount > 0
+
+
+def fail_job(session_id: int, claim_id, error: str):
+    """Schedule a retry of the claimed job, or mark it failed after EVAL_MAX_ATTEMPTS attempts.
+
+    Returns the new status, None if the claim was lost.
+    """
+    query = sql.SQL(
+        "UPDATE {table_name} SET "
+        "status = CASE WHEN attempts >= %(max_attempts)s AND NOT requeued THEN %(failed)s ELSE %(pending)s END, "
+        "run_after = CASE WHEN requeued THEN NOW() "
+        "                 ELSE NOW() + make_interval(secs => %(delay)s * power(2, attempts - 1)) END, "
+        "attempts = CASE WHEN requeued THEN 0 ELSE attempts END, requeued = FALSE, "
+        "last_error = %(error)s, updated_at = NOW() "
+        "WHERE session_id = %(session_id)s AND status = %(running)s AND claim_id = %(claim_id)s RETURNING status"
+    ).format(table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        row = conn.execute(query, {'max_attempts': EVAL_MAX_ATTEMPTS, 'failed': FAILED, 'pending': PENDING,
+                                   'running': RUNNING, 'delay': EVAL_RETRY_DELAY, 'error': error,
+                                   'session_id': session_id, 'claim_id': claim_id}).fetchone()
+    return row[0] if row else None
+
+
+def count_jobs(status: str, timeout: float = None) -> int:
+    """Jobs in the status, waiting at most `timeout` seconds for a connection (the pool default if None)."""
+    query = sql.SQL("SELECT count(*) FROM {table_name} WHERE status = %s").format(table_name=sql.Identifier(table_name))
+    with get_pool().connection(timeout=timeout) as conn:
+        return conn.execute(query, (status,)).fetchone()[0]
+
+
+class EvaluationWorkers:
+    """Pool of threads running queued evaluations, at most `concurrency` at a time."""
+
+    def __init__(self, handler, concurrency: int = 2, poll_interval: float = EVAL_POLL_INTERVAL):
+        self._handler = handler
+        self._concurrency = concurrency
+        self._poll_interval = poll_interval
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stopped.clear()
+        self._spawn(stop_when_empty=False)
+        log.info(f'Started {self._concurrency} evaluation workers')
+
+    def stop(self, timeout: float = 60):
+        """Stop after the evaluations in progress, queued jobs stay in the table."""
+        self._stopped.set()
+        _wakeup.set()
+        self._join(timeout)
+
+    def run_until_empty(self):
+        """Run all due jobs and return, used by the CLI."""
+        self._stopped.clear()
+        self._spawn(stop_when_empty=True)
+        self._join()
+
+    def _spawn(self, stop_when_empty):
+        for i in range(self._concurrency):
+            t = threading.Thread(target=self._work, args=(stop_when_empty,), name=f'evaluation-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _join(self, timeout=None):
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _work(self, stop_when_empty):
+        while not self._stopped.is_set():
+            try:
+                claim = claim_job()
+            except Exception as e:
+                log.error(f'Failed to claim evaluation job: {str(e)}')
+                claim = None
+            if claim is None:
+                if stop_when_empty:
+                    return
+                if _wakeup.wait(self._poll_interval):
+                    _wakeup.clear()
+                continue
+            session_id, claim_id = claim
+            try:
+                self._handler(session_id)
+            except Exception as e:
+                status = fail_job(session_id, claim_id, str(e))
+                if status == PENDING:
+                    retries.inc(operation='evaluation')
+                else:
+                    errors.inc(operation='evaluation')
+                log.error(f'Evaluation of session {session_id} failed ({status}): {str(e)}')
+                continue
+            try:
+                completed = complete_job(session_id, claim_id)
+            except Exception as e:
+                # the job is claimed again after EVAL_JOB_TIMEOUT
+                log.error(f'Failed to complete evaluation job of session {session_id}: {str(e)}')
+                continue
+            if completed:
+                log.info(f'Evaluation of session {session_id} done')
+            else:
+                log.warning(f'Evaluation of session {session_id} finished after its job was claimed again')
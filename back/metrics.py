@@ -0,0 +1,223 @@
+"""Process metrics in the Prometheus text exposition format.
+
+A minimal registry of counters, gauges and histograms served by the /metrics
+route. Metrics are per process, labels are passed as keyword arguments:
+
+    llm_seconds.observe(1.2, call='interview')
+    with db_seconds.time(function='get_chat'):
+        ...
+"""
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a cached query to a slow LLM reply
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for k, v in labels)
+    return '{' + pairs + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self._samples():
+            lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only increase')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Gauge set explicitly or, with set_function, read at scrape time."""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, func, **labels):
+        """Take the value of the labels from func() on every scrape, func failing leaves the sample out."""
+        self._functions[self._key(labels)] = func
+
+    def _samples(self):
+        samples = super()._samples()
+        for key, func in list(self._functions.items()):
+            try:
+                samples.append((self.name, key, func()))
+            except Exception:
+                pass
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, **self._labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # per bucket (not cumulative) counts, sum
+                counts = self._values[key] = [[0] * len(self.buckets), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def time(self, **labels) -> _Timer:
+        """Context manager observing the duration of the block."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((f'{self.name}_bucket', key + (('le', _format_value(bound)),), cumulative))
+                samples.append((f'{self.name}_sum', key, total))
+                samples.append((f'{self.name}_count', key, cumulative))
+        return samples
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+webhook_seconds = Histogram('webhook_seconds', 'Telegram update handling time, request - webhook call, '
+                            'handle - processing of the update', ['stage'])
+llm_seconds = Histogram('llm_seconds', 'LLM call latency', ['call'])
+db_seconds = Histogram('db_seconds', 'Supabase request latency, per attempt', ['function'])
+chat_history_seconds = Histogram('chat_history_seconds', 'Chat history query time', ['operation'])
+
+llm_tokens = Counter('llm_tokens_total', 'LLM tokens', ['call', 'kind'])
+llm_cost = Counter('llm_cost_usd_total', 'LLM cost in USD', ['call'])
+retries = Counter('retries_total', 'Retried operations', ['operation'])
+errors = Counter('errors_total', 'Failed operations', ['operation'])
+
+active_interviews = Gauge('active_interviews', 'Chats in the interview state')
+queue_depth = Gauge('queue_depth', 'Queued work items', ['queue'])
+circuit_open = Gauge('circuit_open', 'Circuit breaker state, 1 - open', ['backend'])
+checkpoint_threads = Gauge('checkpoint_threads', 'Interview graph threads with checkpoints in memory')
+checkpoint_bytes = Gauge('checkpoint_bytes', 'Serialized size of the interview graph checkpoints in memory')
+resident_memory = Gauge('process_resident_memory_bytes', 'Resident memory size of the process')
+pool_connections = Gauge('db_pool_connections', 'Postgres pool connections, size - opened, available - idle',
+                         ['pool', 'state'])
+pool_waiting = Gauge('db_pool_waiting', 'Requests waiting for a Postgres pool connection', ['pool'])
+cache_hits = Gauge('cache_hits', 'Hits of the TTL cache of the function since the start', ['function'])
+cache_misses = Gauge('cache_misses', 'Misses of the TTL cache of the function since the start', ['function'])
+cache_size = Gauge('cache_size', 'Entries in the TTL cache of the function', ['function'])
+
+
+def _resident_memory_bytes() -> int:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+# left out of the scrape where /proc is not available
+resident_memory.set_function(_resident_memory_bytes)
+
+
+def observe_db(func):
+    """Time every call of a Supabase data-access function and count its failures.
+
+    Applied under @retry, so each attempt is observed separately. Coroutine functions are
+    supported too.
+    """
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with db_seconds.time(function=func.__name__):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    errors.inc(operation=func.__name__)
+                    raise
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with db_seconds.time(function=func.__name__):
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                errors.inc(operation=func.__name__)
+                raise
+    return wrapper
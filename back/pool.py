@@ -0,0 +1,91 @@
+import logging
+import threading
+
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
+
+from back import metrics
+from config import conn_info, PG_POOL_MIN, PG_POOL_MAX, PG_POOL_MAX_IDLE
+
+log = logging.getLogger(__name__)
+
+# prepare_threshold=None - server side prepared statements do not work through pgbouncer (supabase pooler)
+_kwargs = {'prepare_threshold': None}
+
+_pool = None
+_apool = None
+_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Process-wide sync connection pool, opened on first use."""
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = ConnectionPool(conn_info,
+                                       min_size=PG_POOL_MIN,
+                                       max_size=PG_POOL_MAX,
+                                       max_idle=PG_POOL_MAX_IDLE,
+                                       kwargs=_kwargs,
+                                       check=ConnectionPool.check_connection,
+                                       name='hrbot',
+                                       open=True)
+                log.info(f'Opened postgres pool min={PG_POOL_MIN} max={PG_POOL_MAX}')
+                _register_metrics('sync')
+    return _pool
+
+
+async def get_async_pool() -> AsyncConnectionPool:
+    """Process-wide async connection pool, must be first used from the running event loop."""
+    global _apool
+    if _apool is None:
+        apool = AsyncConnectionPool(conn_info,
+                                    min_size=PG_POOL_MIN,
+                                    max_size=PG_POOL_MAX,
+                                    max_idle=PG_POOL_MAX_IDLE,
+                                    kwargs=_kwargs,
+                                    check=AsyncConnectionPool.check_connection,
+                                    name='hrbot-async',
+                                    open=False)
+        await apool.open()
+        if _apool is None:
+            _apool = apool
+            log.info(f'Opened async postgres pool min={PG_POOL_MIN} max={PG_POOL_MAX}')
+            _register_metrics('async')
+        else:
+            await apool.close()
+    return _apool
+
+
+def pool_stats() -> dict:
+    """Statistics of the opened pools, see psycopg_pool docs for the keys."""
+    stats = {}
+    if _pool is not None:
+        stats['sync'] = _pool.get_stats()
+    if _apool is not None:
+        stats['async'] = _apool.get_stats()
+    return stats
+
+
+def _register_metrics(pool: str):
+    # read on every scrape, a closed pool is left out
+    metrics.pool_connections.set_function(lambda: pool_stats()[pool]['pool_size'], pool=pool, state='size')
+    metrics.pool_connections.set_function(lambda: pool_stats()[pool]['pool_available'], pool=pool, state='available')
+    metrics.pool_waiting.set_function(lambda: pool_stats()[pool]['requests_waiting'], pool=pool)
+
+
+def close_pool():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            log.info(f'Closing postgres pool {_pool.get_stats()}')
+            _pool.close()
+            _pool = None
+
+
+async def aclose_pool():
+    global _apool
+    if _apool is not None:
+        apool, _apool = _apool, None
+        log.info(f'Closing async postgres pool {apool.get_stats()}')
+        await apool.close()
@@ -0,0 +1,187 @@
+"""Resume text extraction from PDF.
+
+The PDF is parsed from memory in a pool of worker processes, large documents are
+split across the workers by page ranges. Size, page count and parsing time are
+bounded. A document hanging the parser retires the pool: new extractions get a
+fresh one and the old pool is terminated once the extractions using it are done,
+so other chats' documents parsed at the same time are not lost.
+
+Extracted texts are cached by Telegram file_unique_id and by content hash, so a
+resume uploaded again is neither downloaded nor parsed twice.
+"""
+import hashlib
+import logging
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from PyPDF2 import PdfReader
+from psycopg.rows import dict_row
+
+from back.pool import get_pool
+
+from config import RESUME_MAX_BYTES, RESUME_MAX_PAGES, RESUME_PAGES_PER_TASK, RESUME_TIMEOUT, RESUME_WORKERS
+
+log = logging.getLogger(__name__)
+
+_pool = None
+_users = {}  # pool -> number of extractions using it
+_lock = threading.Lock()
+
+
+class ResumeError(ValueError):
+    """The resume can not be processed, the message is shown to the candidate."""
+
+
+def _count_pages(data: bytes) -> int:
+    return len(PdfReader(BytesIO(data)).pages)
+
+
+def _extract_pages(data: bytes, start: int, end: int):
+    reader = PdfReader(BytesIO(data))
+    return [reader.pages[i].extract_text() for i in range(start, end)]
+
+
+@contextmanager
+def _use_pool():
+    """The current pool, a retired pool is terminated when its last user is done."""
+    global _pool
+    with _lock:
+        if _pool is None:
+            # spawn - forking a process with running threads (db pools, workers) is unsafe
+            _pool = multiprocessing.get_context('spawn').Pool(RESUME_WORKERS)
+        pool = _pool
+        _users[pool] = _users.get(pool, 0) + 1
+    try:
+        yield pool
+    finally:
+        with _lock:
+            _users[pool] -= 1
+            drained = pool is not _pool and _users[pool] == 0
+            if drained:
+                del _users[pool]
+        if drained:
+            pool.terminate()
+
+
+def _retire_pool(pool):
+    """Replace the pool after a document did not finish in time, its workers may hang."""
+    global _pool
+    with _lock:
+        if _pool is pool:
+            _pool = None
+            pool.close()
+
+
+def close_pool():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+            _pool = None
+
+
+def extract_text_from_pdf(data: bytes, max_pages: int = RESUME_MAX_PAGES, timeout: float = RESUME_TIMEOUT) -> str:
+    """Extract text from a PDF file content.
+
+    Only the first `max_pages` pages are extracted. Raises ResumeError when the file is
+    too large, is not a readable PDF or is not parsed within `timeout` seconds.
+    """
+    if len(data) > RESUME_MAX_BYTES:
+        raise ResumeError(f"Файл слишком большой, максимальный размер {RESUME_MAX_BYTES // (1024 * 1024)} МБ.")
+    deadline = time.monotonic() + timeout
+    with _use_pool() as pool:
+        try:
+            num_pages = pool.apply_async(_count_pages, (data,)).get(timeout)
+            if num_pages > max_pages:
+                log.info(f'Resume has {num_pages} pages, extracting the first {max_pages}')
+                num_pages = max_pages
+            tasks = [pool.apply_async(_extract_pages, (data, start, min(start + RESUME_PAGES_PER_TASK, num_pages)))
+                     for start in range(0, num_pages, RESUME_PAGES_PER_TASK)]
+            pages = []
+            for task in tasks:
+                pages.extend(task.get(max(deadline - time.monotonic(), 0)))
+        except multiprocessing.TimeoutError:
+            log.error(f'Resume extraction timed out after {timeout}s')
+            _retire_pool(pool)
+            raise ResumeError("Не удалось обработать файл, попробуйте загрузить другой .pdf.")
+        except Exception as e:
+            log.error(f'Resume extraction failed: {str(e)}')
+            raise ResumeError("Не удалось прочитать файл, проверьте что это корректный .pdf.")
+    return ''.join(page + "\n" for page in pages)
+
+
+def create_tables(connection):
+    statements = [
+        """
+        CREATE TABLE IF NOT EXISTS resume_cache (
+            file_unique_id TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_resume_cache_content_hash ON resume_cache (content_hash);",
+        # hash of the resume currently stored in the chat
+        """
+        CREATE TABLE IF NOT EXISTS chat_resume (
+            chat_id BIGINT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+    ]
+    for statement in statements:
+        connection.execute(statement)
+    connection.commit()
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_cached_resume(chat_id: int, file_unique_id: str):
+    """Cached resume of the Telegram file, dict(content_hash, text, is_current) or None.
+
+    is_current - the text is already the resume of the chat.
+    """
+    with get_pool().connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(
+                "SELECT r.content_hash, r.text, c.content_hash IS NOT DISTINCT FROM r.content_hash AS is_current "
+                "FROM resume_cache r LEFT JOIN chat_resume c ON c.chat_id = %s "
+                "WHERE r.file_unique_id = %s",
+                (chat_id, file_unique_id))
+            return cur.fetchone()
+
+
+def get_resume_by_hash(chat_id: int, data_hash: str):
+    """Cached resume with the same content uploaded as another file, same dict as get_cached_resume."""
+    with get_pool().connection() as conn:
+        with conn.cursor(row_factory=dict_row) as cur:
+            cur.execute(
+                "SELECT r.content_hash, r.text, c.content_hash IS NOT DISTINCT FROM r.content_hash AS is_current "
+                "FROM resume_cache r LEFT JOIN chat_resume c ON c.chat_id = %s "
+                "WHERE r.content_hash = %s LIMIT 1",
+                (chat_id, data_hash))
+            return cur.fetchone()
+
+
+def store_resume(file_unique_id: str, data_hash: str, text: str):
+    with get_pool().connection() as conn:
+        conn.execute(
+            "INSERT INTO resume_cache (file_unique_id, content_hash, text) VALUES (%s, %s, %s) "
+            "ON CONFLICT (file_unique_id) DO NOTHING",
+            (file_unique_id, data_hash, text))
+
+
+def set_chat_resume(chat_id: int, data_hash: str):
+    """Remember which resume the chat has, call after the chat was updated."""
+    with get_pool().connection() as conn:
+        conn.execute(
+            "INSERT INTO chat_resume (chat_id, content_hash) VALUES (%s, %s) "
+            "ON CONFLICT (chat_id) DO UPDATE SET content_hash = EXCLUDED.content_hash, updated_at = NOW()",
+            (chat_id, data_hash))
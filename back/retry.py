@@ -0,0 +1,259 @@
+"""Retry policy of backend calls: deadline budget, jittered backoff and circuit breakers.
+
+    @retry(breaker='supabase')
+    def get_chat(chat_id): ...
+
+Only transient errors (network, timeouts, 5xx, 429, lost connections) are
+retried. Calls which must not be applied twice pass
+`transient=is_transient_not_applied`, retrying only failures after which the
+request certainly had no effect. The wait before a retry is drawn from [0, backoff] ("full jitter"),
+and no retry is made which would end after the deadline: the smaller of the
+call's own budget and the one set for the whole request with `deadline()`.
+Transient failures of a backend open its circuit breaker, calls then fail
+fast with CircuitOpenError until a trial call after `reset_timeout` succeeds.
+
+The decorator works for plain and coroutine functions.
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+import httpx
+import psycopg
+
+from back.metrics import retries, circuit_open
+from config import (RETRY_TRIES, RETRY_DELAY, RETRY_MAX_DELAY, RETRY_BUDGET,
+                    BREAKER_FAILURES, BREAKER_RESET_TIMEOUT)
+
+log = logging.getLogger(__name__)
+
+# SQLSTATE classes: connection exception, transaction rollback, insufficient resources, operator intervention
+_TRANSIENT_SQLSTATE = ('08', '40', '53', '57')
+
+# monotonic time by which the current request has to be done, None - no deadline
+_deadline: ContextVar[Optional[float]] = ContextVar('deadline', default=None)
+
+
+class CircuitOpenError(RuntimeError):
+    """The backend failed repeatedly, the call was not made."""
+
+
+def is_transient(e: BaseException) -> bool:
+    """Whether the error may go away when the call is repeated."""
+    if isinstance(e, (httpx.TransportError, ConnectionError, TimeoutError, psycopg.OperationalError)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    if isinstance(e, psycopg.Error):
+        return bool(e.sqlstate) and e.sqlstate[:2] in _TRANSIENT_SQLSTATE
+    # postgrest APIError: SQLSTATE, PostgREST code or the HTTP status of a non-JSON response
+    code = str(getattr(e, 'code', None) or '')
+    if code.isdigit() and len(code) == 3:
+        return int(code) >= 500 or code == '429'
+    return len(code) == 5 and code[:2] in _TRANSIENT_SQLSTATE
+
+
+def is_transient_not_applied(e: BaseException) -> bool:
+    """Whether the error may go away and the failed call certainly had no effect.
+
+    For non-idempotent calls: a request which timed out or lost its connection
+    after it was sent may have been applied, it is not repeated.
+    """
+    if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        # the request was not sent
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in (429, 503)
+    if isinstance(e, (httpx.TransportError, ConnectionError, TimeoutError, psycopg.Error)):
+        return False
+    # postgrest APIError: the statement failed and was rolled back, or the request was rejected
+    code = str(getattr(e, 'code', None) or '')
+    if code.isdigit() and len(code) == 3:
+        return code in ('429', '503')
+    return len(code) == 5 and code[:2] in _TRANSIENT_SQLSTATE
+
+
+@contextmanager
+def deadline(seconds: float):
+    """Limit retries of all calls made in the block to `seconds` from now.
+
+    Nested deadlines can only shorten the outer one.
+    """
+    current = _deadline.get()
+    new = time.monotonic() + seconds
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive transient failures.
+
+    While open every call fails fast, after `reset_timeout` seconds a single trial
+    call is let through (half-open): its success closes the circuit, its failure
+    opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURES,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        circuit_open.set_function(lambda: int(self.is_open), backend=name)
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self):
+        """Raise CircuitOpenError unless the call may be made."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if not self._trial and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial = True
+                return
+        raise CircuitOpenError(f'{self.name} is unavailable')
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                log.info(f'Circuit {self.name} closed')
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or (self._opened_at is None and self._failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    log.error(f'Circuit {self.name} opened after {self._failures} failures')
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Process-wide breaker of the backend."""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+class _Attempts:
+    """Retry decisions of a single call, shared by the sync and async wrappers."""
+
+    def __init__(self, name, breaker, tries, delay, max_delay, budget, transient):
+        self.name = name
+        self.breaker = breaker
+        self.tries = tries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.transient = transient
+        ends = time.monotonic() + budget
+        request_ends = _deadline.get()
+        self.ends = ends if request_ends is None else min(ends, request_ends)
+        self.attempt = 0
+
+    def before(self):
+        self.attempt += 1
+        if self.breaker is not None:
+            self.breaker.allow()
+
+    def succeeded(self):
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+    def wait_after(self, e) -> Optional[float]:
+        """Seconds to wait before the next attempt, None if the error has to be raised."""
+        if not self.transient(e):
+            if not is_transient(e):
+                # the backend answered, the call itself is wrong
+                self.succeeded()
+            elif self.breaker is not None:
+                # a backend failure which is not safe to retry, e.g. a timed out non-idempotent call
+                self.breaker.record_failure()
+            return None
+        if self.breaker is not None:
+            self.breaker.record_failure()
+        if self.attempt >= self.tries:
+            return None
+        wait = random.uniform(0, min(self.max_delay, self.delay * 2 ** (self.attempt - 1)))
+        if time.monotonic() + wait >= self.ends:
+            log.warning(f'{self.name} failed, no time left to retry: {e}')
+            return None
+        retries.inc(operation=self.name)
+        log.warning(f'{self.name} failed, retrying in {wait:.2f}s: {e}')
+        return wait
+
+
+def retry(breaker: Optional[str] = None, tries: int = RETRY_TRIES, delay: float = RETRY_DELAY,
+          max_delay: float = RETRY_MAX_DELAY, budget: float = RETRY_BUDGET, transient=is_transient):
+    """Retry transient failures of the decorated function.
+
+    breaker - name of the backend whose circuit breaker guards the calls
+    tries - attempts at most
+    delay, max_delay - backoff before the n-th retry is up to min(max_delay, delay * 2^(n-1)) seconds
+    budget - seconds after the first attempt in which retries may be made
+    """
+    def decorator(func):
+        name = func.__name__
+
+        def attempts():
+            return _Attempts(name, get_breaker(breaker) if breaker else None,
+                             tries, delay, max_delay, budget, transient)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                state = attempts()
+                while True:
+                    state.before()
+                    try:
+                        result = await func(*args, **kwargs)
+                    except Exception as e:
+                        wait = state.wait_after(e)
+                        if wait is None:
+                            raise
+                        await asyncio.sleep(wait)
+                        continue
+                    state.succeeded()
+                    return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            state = attempts()
+            while True:
+                state.before()
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    wait = state.wait_after(e)
+                    if wait is None:
+                        raise
+                    time.sleep(wait)
+                    continue
+                state.succeeded()
+                return result
+        return wrapper
+    return decorator
@@ -0,0 +1,139 @@
+"""Streaming of interviewer replies to Telegram.
+
+The model answers with the JSON of `Result`, the `question` field is extracted from
+the partial JSON while the reply streams in and is shown to the candidate by
+editing a single Telegram message.
+"""
+import logging
+import time
+
+from langchain_core.messages import message_chunk_to_message
+from langchain_core.utils.json import parse_json_markdown
+from telebot.apihelper import ApiTelegramException
+
+log = logging.getLogger(__name__)
+
+# rate limited attempts of the final edit before the text is sent as a new message
+FINISH_ATTEMPTS = 3
+
+
+def partial_question(text: str):
+    """Value of the `question` field of a possibly incomplete JSON reply, None if not started yet."""
+    try:
+        data = parse_json_markdown(text)
+    except ValueError:
+        return None
+    if isinstance(data, dict) and isinstance(data.get('question'), str):
+        return data['question']
+    return None
+
+
+def stream_question(model, prompt_value, on_question):
+    """Stream the model reply calling on_question with the growing question text.
+
+    If on_question has a `due` method, the partial reply is parsed only when it
+    returns True, so that a long reply is not re-parsed for every chunk.
+    Returns the complete reply as a regular AIMessage.
+    """
+    due = getattr(on_question, 'due', None)
+    response = None
+    question = ''
+    for chunk in model.stream(prompt_value):
+        response = chunk if response is None else response + chunk
+        if due is not None and not due():
+            continue
+        partial = partial_question(response.content)
+        if partial and partial != question:
+            question = partial
+            on_question(question)
+    return message_chunk_to_message(response)
+
+
+class ThrottledMessage:
+    """Telegram message which is sent on the first update and then edited as the text grows.
+
+    Edits are done at most once per `interval` seconds to stay within Telegram rate
+    limits, `finish` always brings the message to its final text. The instance is
+    the on_question callback of stream_question.
+    """
+
+    def __init__(self, bot, chat_id, interval: float = 1.0, min_chars: int = 20, max_retry_after: float = 10):
+        self._bot = bot
+        self._chat_id = chat_id
+        self._interval = interval
+        self._min_chars = min_chars
+        self._max_retry_after = max_retry_after
+        self._message_id = None
+        self._text = ''
+        self._sent_at = 0.0
+
+    def typing(self):
+        self._bot.send_chat_action(self._chat_id, 'typing')
+
+    @property
+    def sent(self) -> bool:
+        return self._message_id is not None
+
+    def due(self) -> bool:
+        """Whether an update would be shown now."""
+        return self._message_id is None or time.monotonic() - self._sent_at >= self._interval
+
+    def update(self, text: str):
+        if self._message_id is None:
+            if len(text) >= self._min_chars:
+                self._send(text)
+        elif time.monotonic() - self._sent_at >= self._interval:
+            self._edit(text)
+
+    __call__ = update
+
+    def finish(self, text: str):
+        if self._message_id is None:
+            self._send(text)
+            return
+        for attempt in range(FINISH_ATTEMPTS):
+            if text == self._text:
+                return
+            try:
+                self._bot.edit_message_text(text, chat_id=self._chat_id, message_id=self._message_id)
+            except ApiTelegramException as e:
+                if _not_modified(e):
+                    return
+                retry_after = _retry_after(e)
+                if retry_after is None or retry_after > self._max_retry_after or attempt == FINISH_ATTEMPTS - 1:
+                    # the streamed message stays truncated, the full text is sent as a new one
+                    log.warning(f'Failed to finish message {self._message_id} in chat {self._chat_id}: {e.description}')
+                    self._send(text)
+                    return
+                time.sleep(retry_after)
+                continue
+            self._text = text
+
+    def _send(self, text: str):
+        msg = self._bot.send_message(self._chat_id, text)
+        self._message_id = msg.message_id
+        self._text = text
+        self._sent_at = time.monotonic()
+
+    def _edit(self, text: str):
+        if text == self._text:
+            return
+        try:
+            self._bot.edit_message_text(text, chat_id=self._chat_id, message_id=self._message_id)
+        except ApiTelegramException as e:
+            # too many requests or message is not modified - the next edit or finish catches up
+            log.warning(f'Failed to edit message {self._message_id} in chat {self._chat_id}: {e.description}')
+            return
+        self._text = text
+        self._sent_at = time.monotonic()
+
+
+def _not_modified(e: ApiTelegramException) -> bool:
+    return e.error_code == 400 and 'message is not modified' in (e.description or '')
+
+
+def _retry_after(e: ApiTelegramException):
+    """Seconds to wait before retrying a rate limited request, None for other errors."""
+    if e.error_code != 429:
+        return None
+    return (e.result_json or {}).get('parameters', {}).get('retry_after', 1)
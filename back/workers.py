@@ -0,0 +1,105 @@
+import logging
+import threading
+from collections import deque
+from queue import Queue
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def update_chat_id(update):
+    """Return the chat id an incoming telebot Update belongs to (None if unknown)."""
+    for attr in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        msg = getattr(update, attr, None)
+        if msg is not None:
+            return msg.chat.id
+    call = getattr(update, 'callback_query', None)
+    if call is not None:
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+    return None
+
+
+class ChatWorkerPool:
+    """Thread pool draining an in-process update queue.
+
+    Updates of the same chat are processed strictly one after another in arrival
+    order, different chats are processed in parallel by up to `num_workers` threads.
+    A chat is owned by at most one worker at a time, so a slow interview never
+    blocks the queue of another chat.
+    """
+
+    def __init__(self, handler, num_workers: int = 8, name: str = 'chat-worker'):
+        self._handler = handler
+        self._num_workers = num_workers
+        self._name = name
+        self._lock = threading.Lock()
+        self._pending = {}  # chat_id -> deque of updates waiting for that chat
+        self._ready = Queue()  # chat ids with pending updates and no active worker
+        self._threads = []
+        self._running = False
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        for i in range(self._num_workers):
+            t = threading.Thread(target=self._work, name=f'{self._name}-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        log.info(f'Started {self._num_workers} webhook workers')
+
+    def stop(self, timeout: float = 30):
+        """Stop accepting updates, let workers drain what is queued and join them."""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        for _ in self._threads:
+            self._ready.put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+        log.info('Webhook workers stopped')
+
+    def submit(self, update):
+        """Queue an update, returns immediately."""
+        chat_id = update_chat_id(update)
+        with self._lock:
+            if not self._running:
+                raise RuntimeError('Worker pool is not running')
+            queue = self._pending.get(chat_id)
+            if queue is not None:
+                # a worker owns this chat already, it will pick the update up in order
+                queue.append(update)
+                return
+            self._pending[chat_id] = deque([update])
+        self._ready.put(chat_id)
+
+    def qsize(self):
+        """Number of updates waiting or in progress."""
+        with self._lock:
+            return sum(len(q) for q in self._pending.values())
+
+    def _work(self):
+        while True:
+            chat_id = self._ready.get()
+            if chat_id is _STOP:
+                break
+            while True:
+                with self._lock:
+                    queue = self._pending[chat_id]
+                    if not queue:
+                        del self._pending[chat_id]
+                        break
+                    update = queue[0]
+                try:
+                    self._handler(update)
+                except Exception as e:
+                    log.error(f'Error processing update {update.update_id} of chat {chat_id}: {str(e)}')
+                finally:
+                    with self._lock:
+                        queue.popleft()
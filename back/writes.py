@@ -0,0 +1,301 @@
+"""Write-behind buffer of non-critical Supabase writes.
+
+Cost increments, session state changes and chat field updates are collected in
+memory, merged per session / chat and written by a background thread every
+WRITE_FLUSH_INTERVAL seconds. The candidate never waits on them, except for the
+end of a session, which is written synchronously (write_session_state) so that
+it is not lost with the buffer once the chat state is cleared.
+
+A batch that can not be written is spilled to the write_outbox table in Postgres
+and retried with exponential backoff by the flusher of any process. While the
+outbox holds rows new batches go there too, so writes are applied in order.
+A cost increment is not idempotent, one which failed after it may have been
+applied (e.g. a response timeout) is dropped rather than repeated.
+Writes buffered in memory are lost if the process is killed before a flush.
+"""
+import itertools
+import json
+import logging
+import threading
+
+from psycopg import sql
+
+from back import db
+from back.metrics import errors, retries
+from back.pool import get_pool
+from back.retry import is_transient_not_applied
+from config import WRITE_FLUSH_INTERVAL, WRITE_MAX_ATTEMPTS, WRITE_RETRY_DELAY
+
+log = logging.getLogger(__name__)
+
+table_name = 'write_outbox'
+
+# outbox rows applied per flush
+OUTBOX_BATCH = 100
+# seconds after which rows claimed by a drain which did not finish are claimed again
+OUTBOX_CLAIM_TIMEOUT = 600
+
+COST = 'cost'
+SESSION = 'session'
+CHAT = 'chat'
+
+# results of _drain_outbox
+DRAINED = 'drained'
+PENDING = 'pending'
+LOCKED = 'locked'
+
+
+def _apply(kind: str, payload: dict):
+    if kind == COST:
+        db.update_cost(payload['session_id'], payload['value'])
+    elif kind == SESSION:
+        db.upsert_session(payload['chat_id'], payload['vacancy_id'], payload['state'])
+    elif kind == CHAT:
+        db.update_chat_info(payload['chat_id'], **payload['fields'])
+    else:
+        raise ValueError(f'Unknown write {kind}')
+
+
+def _may_reapply(kind: str, e: BaseException) -> bool:
+    """Whether a failed write can be applied again, a cost increment which may have been applied can not."""
+    return kind != COST or is_transient_not_applied(e)
+
+
+def create_tables(connection):
+    connection.execute(sql.SQL(
+        """
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload JSONB NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            failed BOOLEAN NOT NULL DEFAULT FALSE,
+            last_error TEXT,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            claimed_until TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """
+    ).format(table_name=sql.Identifier(table_name)))
+    connection.execute(sql.SQL(
+        "ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ;"
+    ).format(table_name=sql.Identifier(table_name)))
+    connection.commit()
+
+
+def _spill(writes):
+    query = sql.SQL("INSERT INTO {table_name} (kind, payload) VALUES (%s, %s)").format(
+        table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.executemany(query, [(kind, json.dumps(payload)) for kind, payload in writes])
+    log.warning(f'Spilled {len(writes)} writes to the outbox')
+
+
+def _outbox_pending() -> bool:
+    query = sql.SQL("SELECT EXISTS (SELECT 1 FROM {table_name} WHERE NOT failed)").format(
+        table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        return conn.execute(query).fetchone()[0]
+
+
+def _drain_outbox() -> str:
+    """Apply outbox rows in order up to the first one waiting for a retry.
+
+    One process drains the outbox at a time: it claims the rows in a short
+    transaction and applies them after the commit, so that no connection is held
+    during the Supabase calls. The rows claimed by a process killed while
+    applying them are claimed again after OUTBOX_CLAIM_TIMEOUT seconds.
+    Returns DRAINED when the outbox is empty, PENDING when rows are left in it
+    and LOCKED when another process drains it and the outbox holds no rows.
+    """
+    lock = "SELECT pg_try_advisory_xact_lock(hashtext(%s))"
+    select = sql.SQL(
+        "SELECT id, kind, payload, run_after <= NOW() FROM {table_name} WHERE NOT failed ORDER BY id LIMIT %s"
+    ).format(table_name=sql.Identifier(table_name))
+    exists = sql.SQL("SELECT EXISTS (SELECT 1 FROM {table_name} WHERE NOT failed)").format(
+        table_name=sql.Identifier(table_name))
+    in_flight = sql.SQL(
+        "SELECT EXISTS (SELECT 1 FROM {table_name} WHERE NOT failed AND claimed_until > NOW())"
+    ).format(table_name=sql.Identifier(table_name))
+    claim = sql.SQL(
+        "UPDATE {table_name} SET claimed_until = NOW() + make_interval(secs => %s) WHERE id = ANY(%s)"
+    ).format(table_name=sql.Identifier(table_name))
+    release = sql.SQL("UPDATE {table_name} SET claimed_until = NULL WHERE id = ANY(%s)").format(
+        table_name=sql.Identifier(table_name))
+    delete = sql.SQL("DELETE FROM {table_name} WHERE id = %s").format(table_name=sql.Identifier(table_name))
+    postpone = sql.SQL(
+        "UPDATE {table_name} SET attempts = attempts + 1, failed = attempts + 1 >= %(max_attempts)s, "
+        "last_error = %(error)s, run_after = NOW() + make_interval(secs => %(delay)s * power(2, attempts)), "
+        "claimed_until = NULL WHERE id = %(id)s RETURNING failed"
+    ).format(table_name=sql.Identifier(table_name))
+    with get_pool().connection() as conn:
+        if not conn.execute(lock, (table_name,)).fetchone()[0]:
+            # rows the other process has not applied yet go before the new writes
+            return PENDING if conn.execute(exists).fetchone()[0] else LOCKED
+        if conn.execute(in_flight).fetchone()[0]:
+            # another process applies the rows it claimed, the following ones wait for it
+            return PENDING
+        rows = conn.execute(select, (OUTBOX_BATCH,)).fetchall()
+        claimed = list(itertools.takewhile(lambda row: row[3], rows))
+        drained = len(rows) < OUTBOX_BATCH and len(claimed) == len(rows)
+        if claimed:
+            conn.execute(claim, (OUTBOX_CLAIM_TIMEOUT, [row[0] for row in claimed]))
+        conn.commit()
+    for i, (row_id, kind, payload, _) in enumerate(claimed):
+        try:
+            _apply(kind, payload)
+        except Exception as e:
+            max_attempts = WRITE_MAX_ATTEMPTS if _may_reapply(kind, e) else 0
+            with get_pool().connection() as conn:
+                failed = conn.execute(postpone, {'max_attempts': max_attempts, 'error': str(e),
+                                                 'delay': WRITE_RETRY_DELAY, 'id': row_id}).fetchone()[0]
+                if not failed:
+                    # the following rows wait too, so that they are not applied before this one
+                    conn.execute(release, ([row[0] for row in claimed[i + 1:]],))
+            if failed:
+                errors.inc(operation='write_outbox')
+                log.error(f'Outbox write {row_id} ({kind}) failed for good: {str(e)}')
+                continue
+            retries.inc(operation='write_outbox')
+            log.error(f'Outbox write {row_id} ({kind}) failed: {str(e)}')
+            return PENDING
+        with get_pool().connection() as conn:
+            conn.execute(delete, (row_id,))
+    return DRAINED if drained else PENDING
+
+
+class WriteBehind:
+    """Buffer of writes merged per key and flushed by a background thread."""
+
+    def __init__(self, flush_interval: float = WRITE_FLUSH_INTERVAL):
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._costs = {}     # session_id -> summed increment
+        self._sessions = {}  # (chat_id, vacancy_id) -> state
+        self._chats = {}     # chat_id -> fields
+        self._flush_lock = threading.Lock()  # batches are applied one after another, in order
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def add_cost(self, session_id, value):
+        if not value:
+            return
+        with self._lock:
+            self._costs[session_id] = self._costs.get(session_id, 0) + value
+
+    def set_session_state(self, chat_id, vacancy_id, state):
+        with self._lock:
+            self._sessions[(chat_id, vacancy_id)] = state
+
+    def write_session_state(self, chat_id, vacancy_id, state):
+        """Write the session state now, e.g. the end of a session before the chat state is cleared.
+
+        The write goes to the outbox while it holds rows, so that it is applied after them.
+        """
+        with self._lock:
+            self._sessions.pop((chat_id, vacancy_id), None)
+        write = (SESSION, {'chat_id': chat_id, 'vacancy_id': vacancy_id, 'state': state})
+        try:
+            pending = _outbox_pending()
+        except Exception as e:
+            log.error(f'Failed to check the write outbox: {str(e)}')
+            pending = True
+        if not pending:
+            try:
+                _apply(*write)
+                return
+            except Exception as e:
+                errors.inc(operation='write_behind')
+                log.error(f'Write of session state {state} failed: {str(e)}')
+        self._spill_or_keep([write])
+
+    def update_chat(self, chat_id, **fields):
+        """Deferred update_chat_info, fields of consecutive updates are merged."""
+        with self._lock:
+            self._chats.setdefault(chat_id, {}).update(fields)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._costs) + len(self._sessions) + len(self._chats)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30):
+        """Stop the flusher and write what is buffered."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def _take(self):
+        with self._lock:
+            writes = ([(COST, {'session_id': k, 'value': v}) for k, v in self._costs.items()]
+                      + [(SESSION, {'chat_id': k[0], 'vacancy_id': k[1], 'state': v}) for k, v in self._sessions.items()]
+                      + [(CHAT, {'chat_id': k, 'fields': v}) for k, v in self._chats.items()])
+            self._costs, self._sessions, self._chats = {}, {}, {}
+        return writes
+
+    def flush(self):
+        """Write what is buffered, called by the flusher and on stop."""
+        with self._flush_lock:
+            writes = self._take()
+            try:
+                outbox = _drain_outbox()
+            except Exception as e:
+                log.error(f'Failed to drain the write outbox: {str(e)}')
+                outbox = PENDING
+            if not writes:
+                return
+            if outbox == PENDING:
+                self._spill_or_keep(writes)
+                return
+            for i, (kind, payload) in enumerate(writes):
+                try:
+                    _apply(kind, payload)
+                except Exception as e:
+                    errors.inc(operation='write_behind')
+                    log.error(f'Write-behind {kind} failed: {str(e)}')
+                    rest = writes[i:]
+                    if not _may_reapply(kind, e):
+                        log.error(f'Write-behind {kind} {payload} may have been applied, it is not repeated')
+                        rest = writes[i + 1:]
+                    if rest:
+                        self._spill_or_keep(rest)
+                    return
+
+    def _spill_or_keep(self, writes):
+        try:
+            _spill(writes)
+        except Exception as e:
+            # Postgres is down as well, keep the writes for the next flush
+            log.error(f'Failed to spill writes to the outbox: {str(e)}')
+            for kind, payload in writes:
+                if kind == COST:
+                    self.add_cost(payload['session_id'], payload['value'])
+                elif kind == SESSION:
+                    with self._lock:
+                        self._sessions.setdefault((payload['chat_id'], payload['vacancy_id']), payload['state'])
+                else:
+                    with self._lock:
+                        self._chats[payload['chat_id']] = {**payload['fields'], **self._chats.get(payload['chat_id'], {})}
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if self._wakeup.wait(self._flush_interval):
+                self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f'Write-behind flush failed: {str(e)}')
+
+
+write_behind = WriteBehind()
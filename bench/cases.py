@@ -0,0 +1,149 @@
+"""Benchmark cases.
+
+A case is a generator function: the code before `yield` prepares the data, the
+yielded callable is timed, the code after it cleans up.
+"""
+import functools
+import json
+from dataclasses import dataclass
+from typing import Callable
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, message_to_dict, messages_from_dict
+
+HISTORY_TABLE = 'bench_chat_history'
+HISTORY_SIZES = (10, 100, 1000)
+REQUIREMENT_COUNTS = (10, 100, 1000)
+
+# allowed slowdown against the baseline, database and multiprocessing cases are noisier
+CPU_THRESHOLD = 0.25
+IO_THRESHOLD = 0.5
+
+ANSWER = ('Последние три года работал бэкенд-разработчиком в финтехе: писал сервисы на Python и FastAPI, '
+          'проектировал схемы в Postgres, настраивал очереди на RabbitMQ и мониторинг в Grafana.')
+QUESTION = 'Расскажите подробнее, как вы решали проблему медленных запросов к базе данных в этом проекте?'
+RESUME = '\n'.join(['Иванов Иван Иванович, Python-разработчик.',
+                    'Опыт: 5 лет, FastAPI, Django, PostgreSQL, Redis, Docker, Kubernetes.'] * 20)
+
+
+@dataclass
+class Case:
+    name: str
+    setup: Callable
+    threshold: float = CPU_THRESHOLD
+
+
+cases = []
+
+
+def case(name: str, threshold: float = CPU_THRESHOLD):
+    def decorator(func):
+        cases.append(Case(name, func, threshold))
+        return func
+    return decorator
+
+
+def conversation(size: int):
+    """Interview messages as they are stored in chat_history, candidate answers and interviewer replies."""
+    messages = []
+    for i in range(size):
+        if i % 2 == 0:
+            messages.append(HumanMessage(content=f'{ANSWER} ({i})'))
+        else:
+            content = json.dumps({'question': f'{QUESTION} ({i})', 'finished': False}, ensure_ascii=False)
+            messages.append(AIMessage(
+                content=content, id=f'run-{i:08d}',
+                response_metadata={'finish_reason': 'stop', 'model_name': 'gpt-4.1-mini-2025-04-14',
+                                   'system_fingerprint': 'fp_0000000000'},
+                usage_metadata={'input_tokens': 2000 + 50 * i, 'output_tokens': 60, 'total_tokens': 2060 + 50 * i,
+                                'input_token_details': {'cache_read': 1792}}))
+    return messages
+
+
+def requirements(vacancy_id: int, count: int):
+    return [{'id': vacancy_id * 10000 + i, 'vacancy_id': vacancy_id, 'name': f'requirement_{i}',
+             'description': f'Опыт работы с технологией номер {i} не менее двух лет'} for i in range(count)]
+
+
+def _history_case(size: int, cached: bool, operation: str):
+    import psycopg
+    from back.custom_postgres import HistoryCache, PostgresChatMessageHistory
+    from config import conn_info
+
+    with psycopg.connect(conn_info) as conn:
+        PostgresChatMessageHistory.create_tables(conn, HISTORY_TABLE)
+        history = PostgresChatMessageHistory(HISTORY_TABLE, size, sync_connection=conn,
+                                             cache=HistoryCache() if cached else None)
+        history.clear()
+        history.add_messages(conversation(size))
+        history.get_messages()
+        if operation == 'get':
+            yield history.get_messages
+        else:
+            turn = conversation(2)
+            yield functools.partial(history.add_messages, turn)
+        PostgresChatMessageHistory.drop_table(conn, HISTORY_TABLE)
+
+
+for _size in HISTORY_SIZES:
+    case(f'history_get[{_size}]', IO_THRESHOLD)(functools.partial(_history_case, _size, False, 'get'))
+    case(f'history_get_cached[{_size}]', IO_THRESHOLD)(functools.partial(_history_case, _size, True, 'get'))
+    case(f'history_add[{_size}]', IO_THRESHOLD)(functools.partial(_history_case, _size, False, 'add'))
+
+
+@case('messages_from_dict[100]')
+def decode_messages():
+    items = [message_to_dict(m) for m in conversation(100)]
+    yield functools.partial(messages_from_dict, items)
+
+
+@case('start_chat_prompt')
+def start_chat_prompt():
+    from langchain_core.prompts import PromptTemplate
+    from back.ai import SessionSnapshot, _session_config, prompt, start_template
+
+    cand = {'name': 'Иванов Иван Иванович', 'resume': RESUME}
+    reqs = requirements(1, 20)
+
+    def build():
+        # the prompt of the greeting, as start_chat and call_model build it
+        config = _session_config(1, cand, reqs, SessionSnapshot(1, []))
+        start_msg = PromptTemplate.from_template(start_template).format(name=cand['name'])
+        return prompt.invoke({'system': config['configurable']['system'], 'messages': [SystemMessage(content=start_msg)]})
+    yield build
+
+
+@case('reply_result')
+def reply_result():
+    from back.ai import reply_result
+
+    text = json.dumps({'question': QUESTION, 'finished': False}, ensure_ascii=False)
+    message = AIMessage(content=text)
+    yield functools.partial(reply_result, message)
+
+
+def _transform_marks_case(count: int):
+    from back import db
+
+    # negative ids do not clash with cached real vacancies
+    vacancy_id = -count
+    db.get_requirement_index.cache.set((vacancy_id,), db.RequirementIndex(vacancy_id, requirements(vacancy_id, count)))
+    marks = {f'requirement_{i}': i % 11 for i in range(count)}
+    yield functools.partial(db.transform_marks, marks, vacancy_id)
+    db.get_requirement_index.invalidate(vacancy_id)
+
+
+for _count in REQUIREMENT_COUNTS:
+    case(f'transform_marks[{_count}]')(functools.partial(_transform_marks_case, _count))
+
+
+def _pdf_case(pages: int):
+    from back.resume import close_pool, extract_text_from_pdf
+    from loadtest.pdf import make_pdf
+
+    data = make_pdf(pages, 'Ivanov Ivan, Python developer, 5 years of FastAPI, PostgreSQL and Redis')
+    yield functools.partial(extract_text_from_pdf, data)
+    close_pool()
+
+
+case('extract_text_from_pdf[2]', IO_THRESHOLD)(functools.partial(_pdf_case, 2))
+case('extract_text_from_pdf[50]', IO_THRESHOLD)(functools.partial(_pdf_case, 50))
@@ -0,0 +1,133 @@
+"""Microbenchmarks of the hot path, compared with stored baselines.
+
+    python -m bench.run                  # run all, compare with bench/baseline.json
+    python -m bench.run -k history       # cases whose name contains 'history'
+    python -m bench.run --save           # store the results as the new baseline
+
+Run from the repository root with the bot's .env, the history cases need the
+Postgres of POSTGRES_URL (they use their own bench_chat_history table).
+
+Every case is timed in `--rounds` rounds of as many calls as fit in ~0.2s with
+the garbage collector off, like timeit. The fastest round is compared with the
+baseline, it is the least disturbed by other load of the machine; the median is
+reported as well. A case slower than its baseline by more than its threshold is
+a regression, the exit status is then 1.
+Baselines depend on the machine, save them on the one the comparison is run on.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)  # prompts and .env are read relative to the repository root
+sys.path.insert(0, ROOT)
+
+from bench.cases import cases
+
+BASELINE = os.path.join(ROOT, 'bench', 'baseline.json')
+ROUND_SECONDS = 0.2
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-k', dest='filter', help='run the cases whose name contains the string')
+    parser.add_argument('--rounds', type=int, default=7, help='timed rounds per case')
+    parser.add_argument('--save', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    return parser.parse_args()
+
+
+def measure(func, rounds: int):
+    """Seconds per call of every round."""
+    func()  # warm up caches, pools and lazy imports
+    gc.collect()
+    gc.disable()
+    try:
+        return _timed_rounds(func, rounds)
+    finally:
+        gc.enable()
+
+
+def _timed_rounds(func, rounds: int):
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= ROUND_SECONDS or number >= 1_000_000:
+            break
+        number = max(number * 2, int(number * ROUND_SECONDS / max(elapsed, 1e-9)))
+    times = [elapsed / number]
+    for _ in range(rounds - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - started) / number)
+    return times
+
+
+def run_case(case, rounds: int):
+    setup = case.setup()
+    func = next(setup)
+    try:
+        return measure(func, rounds)
+    finally:
+        next(setup, None)
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f}{unit}'
+    return f'{seconds / 1e-9:.0f}ns'
+
+
+def main():
+    args = parse_args()
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['cases']
+
+    results = {}
+    regressions = []
+    print(f"{'case':<36}{'median':>10}{'min':>10}{'baseline':>10}{'change':>9}")
+    for case in cases:
+        if args.filter and args.filter not in case.name:
+            continue
+        times = run_case(case, args.rounds)
+        median = statistics.median(times)
+        results[case.name] = {'median': median, 'min': min(times)}
+        line = f'{case.name:<36}{format_time(median):>10}{format_time(min(times)):>10}'
+        base = baseline.get(case.name)
+        if base:
+            change = min(times) / base['min'] - 1
+            line += f"{format_time(base['min']):>10}{change:>+9.1%}"
+            if change > case.threshold:
+                regressions.append(case.name)
+                line += '  REGRESSION'
+        print(line, flush=True)
+
+    if args.save:
+        if args.filter:
+            # keep the baselines of the cases which were not run
+            results = {**baseline, **results}
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                                   'processor': platform.processor() or platform.machine()},
+                       'cases': results}, f, indent=2)
+            f.write('\n')
+        print(f'Baseline saved to {args.baseline}')
+    if regressions:
+        print(f'{len(regressions)} regressions: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,72 @@ SUPABASE_KEY = config.get('SUPABASE_KEY')
 POSTGRES_URL = config.get('POSTGRES_URL')
 MODEL = 'gpt-4o-mini'
 
+# 'queue' - ACK webhook immediately and process updates in the chat worker pool,
+# 'sync' - process updates inside the webhook request
+WEBHOOK_MODE = config.get('WEBHOOK_MODE', 'queue')
+WEBHOOK_WORKERS = int(config.get('WEBHOOK_WORKERS', 8))
+
+PG_POOL_MIN = int(config.get('PG_POOL_MIN', 2))
+PG_POOL_MAX = int(config.get('PG_POOL_MAX', 10))
+PG_POOL_MAX_IDLE = float(config.get('PG_POOL_MAX_IDLE', 600))
+# seconds a metrics scrape waits for a pool connection, the gauges read from Postgres are left out after it
+METRICS_DB_TIMEOUT = float(config.get('METRICS_DB_TIMEOUT', 2))
+
+# stream interviewer replies by editing the Telegram message as the text arrives
+STREAM_REPLIES = config.get('STREAM_REPLIES', 'true').lower() == 'true'
+# min seconds between edits of a streamed message, Telegram rate limits edits per chat
+STREAM_EDIT_INTERVAL = float(config.get('STREAM_EDIT_INTERVAL', 1.0))
+
+# evaluation jobs: parallel evaluations per process, attempts before a job is failed,
+# base retry delay, idle poll interval and the time after which a running job is considered lost (seconds)
+EVAL_WORKERS = int(config.get('EVAL_WORKERS', 2))
+EVAL_MAX_ATTEMPTS = int(config.get('EVAL_MAX_ATTEMPTS', 3))
+EVAL_RETRY_DELAY = float(config.get('EVAL_RETRY_DELAY', 30))
+EVAL_POLL_INTERVAL = float(config.get('EVAL_POLL_INTERVAL', 5))
+EVAL_JOB_TIMEOUT = float(config.get('EVAL_JOB_TIMEOUT', 600))
+
+# resume pdf limits: file size (bytes), extracted pages, pages per worker task, parsing timeout (seconds)
+# and the number of extraction processes
+RESUME_MAX_BYTES = int(config.get('RESUME_MAX_BYTES', 10 * 1024 * 1024))
+RESUME_MAX_PAGES = int(config.get('RESUME_MAX_PAGES', 50))
+RESUME_PAGES_PER_TASK = int(config.get('RESUME_PAGES_PER_TASK', 10))
+RESUME_TIMEOUT = float(config.get('RESUME_TIMEOUT', 30))
+RESUME_WORKERS = int(config.get('RESUME_WORKERS', 2))
+
+# token budget of the interview conversation in the prompt, older turns are summarized
+# when exceeded (0 - send the full history), and the number of last turns always sent verbatim
+CONTEXT_TOKEN_BUDGET = int(config.get('CONTEXT_TOKEN_BUDGET', 16000))
+CONTEXT_KEEP_TURNS = int(config.get('CONTEXT_KEEP_TURNS', 6))
+
+# write-behind of cost and session bookkeeping: seconds between flushes, attempts and base
+# retry delay (seconds) of writes spilled to the outbox
+WRITE_FLUSH_INTERVAL = float(config.get('WRITE_FLUSH_INTERVAL', 2))
+WRITE_MAX_ATTEMPTS = int(config.get('WRITE_MAX_ATTEMPTS', 10))
+WRITE_RETRY_DELAY = float(config.get('WRITE_RETRY_DELAY', 10))
+
+# retries of database calls: attempts, base and max backoff, seconds after the first attempt in
+# which a call may be retried, and the deadline of all calls made while handling an update
+RETRY_TRIES = int(config.get('RETRY_TRIES', 3))
+RETRY_DELAY = float(config.get('RETRY_DELAY', 0.2))
+RETRY_MAX_DELAY = float(config.get('RETRY_MAX_DELAY', 2))
+RETRY_BUDGET = float(config.get('RETRY_BUDGET', 5))
+UPDATE_DEADLINE = float(config.get('UPDATE_DEADLINE', 30))
+# consecutive failures which open the circuit of a backend and seconds until a trial call
+BREAKER_FAILURES = int(config.get('BREAKER_FAILURES', 5))
+BREAKER_RESET_TIMEOUT = float(config.get('BREAKER_RESET_TIMEOUT', 30))
+
+# number of chat histories kept deserialized in memory
+HISTORY_CACHE_SESSIONS = int(config.get('HISTORY_CACHE_SESSIONS', 256))
+# 'sync' - chat history is written before the reply is sent, 'batch' - written in bulk by a
+# background thread, HISTORY_WRITE_BATCH messages at most per transaction
+HISTORY_WRITE_MODE = config.get('HISTORY_WRITE_MODE', 'sync')
+HISTORY_WRITE_BATCH = int(config.get('HISTORY_WRITE_BATCH', 500))
+
+# in-memory checkpoints of the interview graph: max threads kept and seconds after which
+# an idle thread is dropped
+CHECKPOINT_MAX_THREADS = int(config.get('CHECKPOINT_MAX_THREADS', 1024))
+CHECKPOINT_IDLE_TTL = float(config.get('CHECKPOINT_IDLE_TTL', 3600))
+
 
 setup_logger()
 conn_info = POSTGRES_URL
@@ -0,0 +1,91 @@
+"""Deterministic OpenAI-compatible chat completions endpoint for load tests.
+
+Interview requests are answered with the JSON of the interviewer's `Result`,
+the interview is finished once the candidate answered `turns` times. Requests
+with tools (evaluation) get a call of the first tool with a mark for every
+parameter. Every response is delayed by `latency` +- `jitter` seconds.
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def _content_text(message) -> str:
+    content = message.get('content') or ''
+    if isinstance(content, list):
+        return ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content
+
+
+def create_app(latency: float = 1.0, jitter: float = 0.2, turns: int = 3) -> FastAPI:
+    app = FastAPI()
+    app.state.requests = 0
+
+    def reply(body):
+        messages = body.get('messages', [])
+        answers = sum(1 for m in messages if m.get('role') == 'user')
+        prompt_tokens = sum(len(_content_text(m)) // 4 for m in messages)
+        tools = body.get('tools')
+        if tools:
+            function = tools[0]['function']
+            marks = {name: random.Random(prompt_tokens + i).randint(0, 10)
+                     for i, name in enumerate(function.get('parameters', {}).get('properties', {}))}
+            message = {'role': 'assistant', 'content': None,
+                       'tool_calls': [{'id': f'call_{uuid.uuid4().hex[:12]}', 'type': 'function',
+                                       'function': {'name': function['name'], 'arguments': json.dumps(marks)}}]}
+            return message, 'tool_calls', prompt_tokens
+        finished = answers >= turns
+        question = ('Спасибо, интервью завершено.' if finished
+                    else f'Вопрос {answers + 1}: расскажите о самом сложном проекте, над которым вы работали?')
+        content = json.dumps({'question': question, 'finished': finished}, ensure_ascii=False)
+        return {'role': 'assistant', 'content': content}, 'stop', prompt_tokens
+
+    def usage(prompt_tokens, completion_tokens):
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+                'prompt_tokens_details': {'cached_tokens': 0}}
+
+    @app.post('/v1/chat/completions')
+    @app.post('/chat/completions')
+    async def completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        await asyncio.sleep(max(0.0, random.gauss(latency, jitter)))
+        message, finish_reason, prompt_tokens = reply(body)
+        completion_tokens = len(message.get('content') or '') // 4 + 1
+        base = {'id': f'chatcmpl-{uuid.uuid4().hex}', 'created': int(time.time()), 'model': body.get('model')}
+        if not body.get('stream'):
+            return JSONResponse({**base, 'object': 'chat.completion',
+                                 'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+                                 'usage': usage(prompt_tokens, completion_tokens)})
+
+        def chunk(delta, finish=None, with_usage=False):
+            data = {**base, 'object': 'chat.completion.chunk',
+                    'choices': [] if with_usage else [{'index': 0, 'delta': delta, 'finish_reason': finish}]}
+            if with_usage:
+                data['usage'] = usage(prompt_tokens, completion_tokens)
+            return f'data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+        async def events():
+            if message.get('tool_calls'):
+                call = message['tool_calls'][0]
+                yield chunk({'role': 'assistant', 'tool_calls': [{**call, 'index': 0}]})
+            else:
+                content = message['content']
+                step = max(1, len(content) // 4)
+                yield chunk({'role': 'assistant', 'content': ''})
+                for i in range(0, len(content), step):
+                    yield chunk({'content': content[i:i + step]})
+            yield chunk({}, finish_reason)
+            if (body.get('stream_options') or {}).get('include_usage'):
+                yield chunk({}, with_usage=True)
+            yield 'data: [DONE]\n\n'
+
+        return StreamingResponse(events(), media_type='text/event-stream')
+
+    return app
@@ -0,0 +1,282 @@
+"""Load test of the bot webhook.
+
+N simulated candidates go concurrently through the whole flow - /start, FIO,
+email, resume pdf, vacancy selection, interview and evaluation - by posting
+Telegram updates to the /{BOT_TOKEN}/ route of main.app. Telegram and OpenAI are
+replaced by local stubs (loadtest/telegram_stub.py, loadtest/fake_llm.py), the
+databases are real: a local Supabase stack (`supabase start`) with
+loadtest/schema.sql applied, SUPABASE_URL / SUPABASE_KEY / POSTGRES_URL in .env
+pointing at it. Run from the repository root:
+
+    python -m loadtest.run --candidates 50 --turns 5 --llm-latency 1.5
+
+A stage ends when the bot has sent all the messages expected in reply to the
+update, the evaluation stage - counted from the last answer - when the
+evaluation job of the session is done.
+Reports interview turns per second and p50/p95/p99 latency of every stage.
+Streaming of replies is turned off, the chat ids of earlier runs are cleaned up.
+"""
+import argparse
+import asyncio
+import itertools
+import math
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)  # prompts and .env are read relative to the repository root
+sys.path.insert(0, ROOT)
+
+import httpx
+import psycopg
+import telebot
+import uvicorn
+
+from loadtest import fake_llm, telegram_stub
+from loadtest.pdf import make_pdf
+
+BOT_TOKEN = '123456:loadtest'
+VACANCY = 'Load test vacancy'
+
+# sendMessage calls the bot makes in reply to each stage
+STAGE_REPLIES = {
+    'start': 1,  # ask for FIO
+    'fio': 1,  # ask for email
+    'email': 1,  # ask for resume
+    'resume': 2,  # resume received, vacancy list
+    'vacancy': 2,  # vacancy selected, greeting
+    'turn': 1,  # next question
+    'final_turn': 2,  # last reply, interview finished
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--candidates', type=int, default=20, help='concurrent candidates')
+    parser.add_argument('--turns', type=int, default=5, help='candidate answers per interview')
+    parser.add_argument('--ramp', type=float, default=5, help='seconds over which candidates start')
+    parser.add_argument('--think', type=float, default=0, help='seconds a candidate waits before answering')
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='mean fake LLM response time, seconds')
+    parser.add_argument('--llm-jitter', type=float, default=0.2, help='std deviation of the LLM response time')
+    parser.add_argument('--requirements', type=int, default=10, help='requirements of the test vacancy')
+    parser.add_argument('--pages', type=int, default=2, help='pages of the resume pdf')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds a stage may take')
+    parser.add_argument('--webhook-mode', choices=['queue', 'sync'], help='overrides WEBHOOK_MODE')
+    parser.add_argument('--chat-id-base', type=int, default=9_000_000_000, help='first chat id of the candidates')
+    parser.add_argument('--port', type=int, default=18080, help='bot port, the stubs use the next two')
+    return parser.parse_args()
+
+
+def serve(app, port: int):
+    """Run the app in a background thread, returns (server, thread) once it accepts connections."""
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f'Server on port {port} failed to start')
+        time.sleep(0.05)
+    return server, thread
+
+
+def seed(conn_info: str, requirements: int, chat_ids: range) -> int:
+    """Create the test vacancy and remove what earlier runs left for the chat ids, returns the vacancy id."""
+    with psycopg.connect(conn_info) as conn:
+        vacancy_id = conn.execute(
+            "INSERT INTO vacancies (name, description) VALUES (%s, 'Synthetic vacancy of the load test') "
+            "ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name RETURNING id", (VACANCY,)).fetchone()[0]
+        conn.execute("DELETE FROM requirements WHERE vacancy_id = %s", (vacancy_id,))
+        with conn.cursor() as cur:
+            cur.executemany("INSERT INTO requirements (vacancy_id, name, description) VALUES (%s, %s, %s)",
+                            [(vacancy_id, f'requirement_{i}', f'Опыт работы с технологией номер {i}')
+                             for i in range(requirements)])
+        first, last = chat_ids[0], chat_ids[-1]
+        sessions = [row[0] for row in conn.execute(
+            "SELECT id FROM session WHERE chat_id BETWEEN %s AND %s", (first, last))]
+        for table in ('chat_history', 'evaluation_jobs', 'chat_summary', 'session_scores'):
+            conn.execute(f"DELETE FROM {table} WHERE session_id = ANY(%s)", (sessions,))
+        for table in ('chat_state', 'chat_resume'):
+            conn.execute(f"DELETE FROM {table} WHERE chat_id BETWEEN %s AND %s", (first, last))
+        # sessions and marks are deleted by cascade
+        conn.execute("DELETE FROM chat WHERE id BETWEEN %s AND %s", (first, last))
+    return vacancy_id
+
+
+class Updates:
+    """Telegram update payloads of a candidate."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.user = {'id': chat_id, 'is_bot': False, 'first_name': 'Load', 'last_name': str(chat_id)}
+        self.chat = {'id': chat_id, 'type': 'private', 'first_name': 'Load'}
+
+    def _message(self, **fields):
+        update_id = next(self._ids)
+        return {'update_id': update_id,
+                'message': {'message_id': update_id, 'date': int(time.time()), 'from': self.user,
+                            'chat': self.chat, **fields}}
+
+    def text(self, text: str):
+        if text.startswith('/'):
+            return self._message(text=text, entities=[{'type': 'bot_command', 'offset': 0, 'length': len(text)}])
+        return self._message(text=text)
+
+    def document(self, file_id: str, size: int):
+        return self._message(document={'file_id': file_id, 'file_unique_id': file_id, 'file_name': 'resume.pdf',
+                                       'mime_type': 'application/pdf', 'file_size': size})
+
+    def callback(self, data: str):
+        update_id = next(self._ids)
+        return {'update_id': update_id,
+                'callback_query': {'id': str(update_id), 'from': self.user, 'chat_instance': str(self.chat_id),
+                                   'data': data,
+                                   'message': {'message_id': update_id, 'date': int(time.time()),
+                                               'chat': self.chat, 'text': 'Выберите вакансию из списка ниже:'}}}
+
+
+class StageError(Exception):
+    pass
+
+
+class Run:
+    def __init__(self, args, vacancy_id: int, outbox: telegram_stub.Outbox, files: dict, run_id: str):
+        self.args = args
+        self.vacancy_id = vacancy_id
+        self.outbox = outbox
+        self.files = files
+        self.run_id = run_id
+        self.url = f'http://127.0.0.1:{args.port}/{BOT_TOKEN}/'
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.finished = 0
+
+    async def wait_replies(self, chat_id: int, expected: int):
+        ends = time.monotonic() + self.args.timeout
+        while self.outbox.count(chat_id) < expected:
+            if time.monotonic() > ends:
+                raise StageError('timeout')
+            await asyncio.sleep(0.01)
+
+    async def wait_evaluation(self, db: psycopg.AsyncConnection, lock: asyncio.Lock, chat_id: int):
+        ends = time.monotonic() + self.args.timeout
+        while True:
+            async with lock:
+                row = await (await db.execute(
+                    "SELECT j.status FROM evaluation_jobs j JOIN session s ON s.id = j.session_id "
+                    "WHERE s.chat_id = %s AND s.vacancy_id = %s", (chat_id, self.vacancy_id))).fetchone()
+            if row and row[0] == 'done':
+                return
+            if row and row[0] == 'failed':
+                raise StageError('evaluation failed')
+            if time.monotonic() > ends:
+                raise StageError('timeout')
+            await asyncio.sleep(0.1)
+
+    async def candidate(self, n: int, client: httpx.AsyncClient, db, lock):
+        chat_id = self.args.chat_id_base + n
+        updates = Updates(chat_id)
+        file_id = f'{self.run_id}-{chat_id}'
+        self.files[file_id] = make_pdf(self.args.pages, f'Resume of candidate {chat_id}, python developer')
+        stages = [('start', updates.text('/start')),
+                  ('fio', updates.text(f'Нагрузочный Тест {n}')),
+                  ('email', updates.text(f'load{n}@example.com')),
+                  ('resume', updates.document(file_id, len(self.files[file_id]))),
+                  ('vacancy', updates.callback(str(self.vacancy_id)))]
+        stages += [('turn' if i < self.args.turns - 1 else 'final_turn', None) for i in range(self.args.turns)]
+        await asyncio.sleep(self.args.ramp * n / max(1, self.args.candidates))
+        expected = 0
+        stage = None
+        try:
+            for i, (stage, update) in enumerate(stages):
+                if update is None:
+                    if self.args.think:
+                        await asyncio.sleep(self.args.think)
+                    update = updates.text(f'Ответ {i} кандидата {n}: работал с базами данных и очередями.')
+                expected += STAGE_REPLIES[stage]
+                started = time.perf_counter()
+                response = await client.post(self.url, json=update)
+                if response.status_code != 200:
+                    raise StageError(f'http {response.status_code}')
+                await self.wait_replies(chat_id, expected)
+                self.latencies[stage].append(time.perf_counter() - started)
+            stage = 'evaluation'
+            await self.wait_evaluation(db, lock, chat_id)
+            self.latencies[stage].append(time.perf_counter() - started)
+            self.finished += 1
+        except (StageError, httpx.HTTPError) as e:
+            self.errors[f'{stage}: {e.__class__.__name__ if isinstance(e, httpx.HTTPError) else e}'] += 1
+
+    async def run(self, conn_info: str):
+        limits = httpx.Limits(max_connections=self.args.candidates)
+        async with httpx.AsyncClient(timeout=self.args.timeout, limits=limits) as client, \
+                await psycopg.AsyncConnection.connect(conn_info, autocommit=True) as db:
+            lock = asyncio.Lock()
+            await asyncio.gather(*[self.candidate(n, client, db, lock) for n in range(self.args.candidates)])
+
+
+def percentile(values, p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def report(run: Run, elapsed: float, llm_requests: int):
+    turns = len(run.latencies['turn']) + len(run.latencies['final_turn'])
+    print(f'\ncandidates {run.args.candidates}, finished {run.finished}, {elapsed:.1f}s, '
+          f'{llm_requests} LLM requests')
+    print(f'interview turns {turns}, {turns / elapsed:.2f} turns/s\n')
+    print(f"{'stage':<12}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for stage in list(STAGE_REPLIES) + ['evaluation']:
+        values = run.latencies.get(stage)
+        if values:
+            print(f'{stage:<12}{len(values):>7}' + ''.join(f'{percentile(values, p):>9.3f}' for p in (50, 95, 99))
+                  + f'{max(values):>9.3f}')
+    if run.errors:
+        print('\nerrors')
+        for error, count in sorted(run.errors.items()):
+            print(f'  {error}: {count}')
+
+
+def main():
+    args = parse_args()
+    llm_port, telegram_port = args.port + 1, args.port + 2
+
+    # everything below has to be set before main and back/ are imported
+    os.environ['OPENAI_API_BASE'] = os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{llm_port}/v1'
+    import config
+    config.BOT_TOKEN = BOT_TOKEN
+    config.OPEN_AI_KEY = 'sk-loadtest'
+    config.STREAM_REPLIES = False
+    config.EVAL_POLL_INTERVAL = 0.5
+    if args.webhook_mode:
+        config.WEBHOOK_MODE = args.webhook_mode
+    telebot.apihelper.API_URL = f'http://127.0.0.1:{telegram_port}/bot{{0}}/{{1}}'
+    telebot.apihelper.FILE_URL = f'http://127.0.0.1:{telegram_port}/file/bot{{0}}/{{1}}'
+
+    files = {}
+    outbox = telegram_stub.Outbox()
+    llm = fake_llm.create_app(latency=args.llm_latency, jitter=args.llm_jitter, turns=args.turns)
+    servers = [serve(llm, llm_port), serve(telegram_stub.create_app(outbox, files.__getitem__), telegram_port)]
+
+    import main as bot_main
+    servers.append(serve(bot_main.app, args.port))  # its startup creates the tables of back/
+    try:
+        chat_ids = range(args.chat_id_base, args.chat_id_base + args.candidates)
+        run = Run(args, seed(config.conn_info, args.requirements, chat_ids), outbox, files, str(int(time.time())))
+        started = time.perf_counter()
+        asyncio.run(run.run(config.conn_info))
+        report(run, time.perf_counter() - started, llm.state.requests)
+    finally:
+        # the bot first, its shutdown flushes buffered writes and removes the webhook
+        for server, thread in reversed(servers):
+            server.should_exit = True
+            thread.join(30)
+
+
+if __name__ == '__main__':
+    main()
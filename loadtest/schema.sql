@@ -0,0 +1,74 @@
+-- Minimal schema of the Supabase tables used by the bot, for a local Supabase stack
+-- (`supabase start`) the load test runs against. The tables of back/ are created by init_db().
+
+CREATE TABLE IF NOT EXISTS vacancies (
+    id SERIAL PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    description TEXT
+);
+
+CREATE TABLE IF NOT EXISTS requirements (
+    id SERIAL PRIMARY KEY,
+    vacancy_id INTEGER NOT NULL REFERENCES vacancies (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS chat (
+    id BIGINT PRIMARY KEY,
+    name TEXT,
+    email TEXT,
+    resume TEXT,
+    session_id INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS session (
+    id SERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL REFERENCES chat (id) ON DELETE CASCADE,
+    vacancy_id INTEGER NOT NULL REFERENCES vacancies (id) ON DELETE CASCADE,
+    state TEXT NOT NULL,
+    cost DOUBLE PRECISION NOT NULL DEFAULT 0,
+    UNIQUE (chat_id, vacancy_id)
+);
+
+DO $$ BEGIN
+    ALTER TABLE chat ADD CONSTRAINT chat_session_id_fkey
+        FOREIGN KEY (session_id) REFERENCES session (id) ON DELETE SET NULL;
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$;
+
+CREATE TABLE IF NOT EXISTS marks (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL REFERENCES chat (id) ON DELETE CASCADE,
+    requirement_id INTEGER NOT NULL REFERENCES requirements (id) ON DELETE CASCADE,
+    vacancy_id INTEGER,
+    value INTEGER NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE OR REPLACE FUNCTION marks_set_vacancy_id() RETURNS trigger AS $$
+BEGIN
+    SELECT vacancy_id INTO NEW.vacancy_id FROM requirements WHERE id = NEW.requirement_id;
+    RETURN NEW;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS marks_set_vacancy_id ON marks;
+CREATE TRIGGER marks_set_vacancy_id BEFORE INSERT ON marks
+    FOR EACH ROW EXECUTE FUNCTION marks_set_vacancy_id();
+
+CREATE OR REPLACE VIEW latest_marks AS
+SELECT DISTINCT ON (chat_id, requirement_id) id, chat_id, requirement_id, vacancy_id, value, created_at
+FROM marks
+ORDER BY chat_id, requirement_id, created_at DESC, id DESC;
+
+CREATE OR REPLACE VIEW current_sessions AS
+SELECT v.id AS vacancy_id, v.name, count(s.id) AS sessions
+FROM vacancies v LEFT JOIN session s ON s.vacancy_id = v.id
+GROUP BY v.id, v.name;
+
+CREATE OR REPLACE FUNCTION increment_cost(x DOUBLE PRECISION, sesh_id INTEGER) RETURNS void AS $$
+    UPDATE session SET cost = cost + x WHERE id = sesh_id;
+$$ LANGUAGE sql;
+
+-- PostgREST has to see the new tables, views and functions
+NOTIFY pgrst, 'reload schema';
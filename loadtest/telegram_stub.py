@@ -0,0 +1,78 @@
+"""Telegram Bot API stand-in for load tests.
+
+Records the messages the bot sends per chat and serves the files of documents
+sent by the candidates. telebot is pointed at it through telebot.apihelper.API_URL
+and FILE_URL.
+"""
+import itertools
+import json
+import threading
+import time
+from collections import defaultdict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+
+class Outbox:
+    """Messages sent by the bot, per chat."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._messages = defaultdict(list)  # chat_id -> [(time, method, text)]
+
+    def record(self, chat_id: int, method: str, text: str):
+        with self._lock:
+            self._messages[chat_id].append((time.perf_counter(), method, text))
+
+    def count(self, chat_id: int, method: str = 'sendMessage') -> int:
+        with self._lock:
+            return sum(1 for _, m, _ in self._messages[chat_id] if m == method)
+
+    def texts(self, chat_id: int):
+        with self._lock:
+            return [text for _, m, text in self._messages[chat_id] if m == 'sendMessage']
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(len(messages) for messages in self._messages.values())
+
+
+def create_app(outbox: Outbox, files) -> FastAPI:
+    """files - file_id -> bytes of the file"""
+    app = FastAPI()
+    message_ids = itertools.count(1)
+
+    def message(chat_id, text):
+        return {'message_id': next(message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+    @app.api_route('/bot{token}/{method}', methods=['GET', 'POST'])
+    async def api(token: str, method: str, request: Request):
+        params = dict(request.query_params)
+        if request.method == 'POST':
+            content_type = request.headers.get('content-type', '')
+            if 'json' in content_type:
+                params.update(await request.json())
+            elif content_type:
+                params.update({k: v for k, v in (await request.form()).items() if isinstance(v, str)})
+        chat_id = int(params['chat_id']) if 'chat_id' in params else None
+        if method in ('sendMessage', 'editMessageText'):
+            outbox.record(chat_id, method, params.get('text', ''))
+            result = message(chat_id, params.get('text', ''))
+        elif method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'hrbot', 'username': 'hrbot'}
+        elif method == 'getFile':
+            file_id = params['file_id']
+            result = {'file_id': file_id, 'file_unique_id': file_id,
+                      'file_size': len(files(file_id)), 'file_path': f'documents/{file_id}'}
+        else:
+            # setWebhook, deleteWebhook, sendChatAction, answerCallbackQuery ...
+            result = True
+        return Response(json.dumps({'ok': True, 'result': result}), media_type='application/json')
+
+    @app.get('/file/bot{token}/documents/{file_id}')
+    async def file(token: str, file_id: str):
+        return Response(files(file_id), media_type='application/octet-stream')
+
+    return app
@@ -1,6 +1,8 @@
+import asyncio
 import logging
 import json
 from contextlib import asynccontextmanager
+from typing import Optional
 
 import telebot
 import os
@@ -8,17 +10,29 @@ from telebot.types import ReplyKeyboardMarkup, KeyboardButton
 from telebot import TeleBot, types
 from pydantic import BaseModel
 from fastapi.templating import Jinja2Templates
-from PyPDF2 import PdfReader
-from fastapi import FastAPI, Request, Response, Body
-from fastapi.responses import JSONResponse
-from config import BOT_TOKEN
-from back.ai import start_chat, evaluate
+from fastapi import FastAPI, HTTPException, Request, Response, Body
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from config import (BOT_TOKEN, WEBHOOK_MODE, WEBHOOK_WORKERS, STREAM_REPLIES, STREAM_EDIT_INTERVAL, EVAL_WORKERS, RESUME_MAX_BYTES,
+                    UPDATE_DEADLINE, METRICS_DB_TIMEOUT)
+from back.ai import (start_chat, resume_chat, score_session, history_writer, wait_history_written,
+                     memory as checkpoints)
+from back.jobs import EvaluationWorkers, enqueue_evaluation, count_jobs, PENDING
+from back.chat_state import (get_chat_state, set_chat_state, clear_chat_state, count_chats,
+                             AWAIT_FIO, AWAIT_EMAIL, AWAIT_RESUME, SELECT_VACANCY, INTERVIEW)
+from back.workers import ChatWorkerPool
+from back.streaming import ThrottledMessage
+from back.resume import (extract_text_from_pdf, ResumeError, close_pool as close_resume_pool, content_hash,
+                         get_cached_resume, get_resume_by_hash, store_resume, set_chat_resume)
+from back.pool import close_pool, aclose_pool
+from back import metrics, adb
+from back.writes import write_behind
+from back.retry import deadline
 from back.db import (get_chat,
                      get_vacancy, get_requirements,
                      update_marks, update_chat_info, get_opened_vacancies,
                      get_vacancy_id, transform_marks, get_requirements_ids, get_session, upsert_session,
-                     get_session_state, get_all_candidates, get_candidate_details, get_all_vacancies,
-                     get_candidates_by_vacancy, init_db, get_marks, get_session_by_id, update_cost
+                     get_session_state, get_all_candidates, init_db, get_marks, get_session_by_id, update_cost
                      )
 
 log = logging.getLogger(__file__)
@@ -38,11 +52,24 @@ async def lifespan(app: FastAPI):
         )
 
         init_db()
+        if WEBHOOK_MODE == 'queue':
+            worker_pool.start()
+        evaluation_workers.start()
+        write_behind.start()
 
         log.info(f'Webhook setup completed {webhook_url}')
         yield
     finally:
         # Cleanup
+        worker_pool.stop()
+        evaluation_workers.stop()
+        write_behind.stop()
+        if history_writer is not None:
+            history_writer.stop()
+        close_resume_pool()
+        close_pool()
+        await aclose_pool()
+        await adb.close_client()
         try:
             bot.remove_webhook()
             log.info('Webhook removed during shutdown')
@@ -54,8 +81,35 @@ app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None)
 # Dictionary to store user data
 user_data = {}
 
-# Initialize bot
-bot = TeleBot(BOT_TOKEN)
+# Initialize bot, handlers are run by our own worker pool instead of telebot's thread pool
+bot = TeleBot(BOT_TOKEN, threaded=False)
+
+
+def handle_update(update):
+    # database calls of one update share the deadline, a handler chaining several of them
+    # does not retry each one for its full budget
+    with metrics.webhook_seconds.time(stage='handle'), deadline(UPDATE_DEADLINE):
+        try:
+            bot.process_new_updates([update])
+        except Exception:
+            metrics.errors.inc(operation='update')
+            raise
+
+
+worker_pool = ChatWorkerPool(handle_update, num_workers=WEBHOOK_WORKERS)
+evaluation_workers = EvaluationWorkers(score_session, concurrency=EVAL_WORKERS)
+
+# read on every scrape, active interviews and evaluation jobs are shared by all processes,
+# a scrape waits at most METRICS_DB_TIMEOUT seconds for a Postgres connection
+metrics.active_interviews.set_function(lambda: count_chats(INTERVIEW, timeout=METRICS_DB_TIMEOUT))
+metrics.queue_depth.set_function(worker_pool.qsize, queue='updates')
+metrics.queue_depth.set_function(lambda: count_jobs(PENDING, timeout=METRICS_DB_TIMEOUT), queue='evaluations')
+metrics.queue_depth.set_function(write_behind.pending, queue='writes')
+if history_writer is not None:
+    metrics.queue_depth.set_function(history_writer.qsize, queue='chat_history')
+# per process, like the queues of its workers
+metrics.checkpoint_threads.set_function(lambda: checkpoints.stats()['threads'])
+metrics.checkpoint_bytes.set_function(lambda: checkpoints.stats()['bytes'])
 
 WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', 'localhost')
 WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
@@ -71,42 +125,75 @@ WEBHOOK_URL_PATH = f"/{BOT_TOKEN}/"
 
 @app.post(f"/{BOT_TOKEN}/")
 
-def process_webhook(request: dict = Body(...)):
+async def process_webhook(request: dict = Body(...)):
     #if request.method != "POST":
     #    return JSONResponse({"error": "Invalid request method"}, status_code=405)
 
-    try:
-        update = request
-        update = types.Update.de_json(update)
-        bot.process_new_updates([update])
-        return {"status": "ok"}
-    except Exception as e:
-        log.error(f"Webhook error: {str(e)}")
-        return {"status": "error"}, 500
+    with metrics.webhook_seconds.time(stage='request'):
+        try:
+            update = request
+            update = types.Update.de_json(update)
+            if WEBHOOK_MODE == 'queue':
+                worker_pool.submit(update)
+            else:
+                # handlers are blocking, run them off the event loop
+                await run_in_threadpool(handle_update, update)
+            return {"status": "ok"}
+        except Exception as e:
+            log.error(f"Webhook error: {str(e)}")
+            metrics.errors.inc(operation='webhook')
+            return {"status": "error"}, 500
+
+
+@app.get("/metrics")
+def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 
 templates = Jinja2Templates(directory="templates")
 
 @app.get("/vacancies")
-def read_candidates(request: Request):
-    vacancies = get_all_vacancies()
+async def read_candidates(request: Request):
+    vacancies = await adb.get_all_vacancies()
     return templates.TemplateResponse("vacancies.html", {"request": request, "vacancies": vacancies})
 
 @app.get("/vacancies/{vacancy_id}/candidates")
-def candidates_page(request: Request, vacancy_id: int):
-    candidates = get_candidates_by_vacancy(vacancy_id)
-    vacancy_name = get_vacancy(vacancy_id)['name']
-    return templates.TemplateResponse("candidates.html", {"request": request, "candidates": candidates, "vacancy_id": vacancy_id, "vacancy_name": vacancy_name})
+async def candidates_page(request: Request, vacancy_id: int, sort: str = 'score', state: Optional[str] = None,
+                          min_score: Optional[str] = None, cursor: Optional[str] = None):
+    # empty form fields come as empty strings
+    try:
+        min_score = float(min_score) if min_score else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid min_score")
+    (candidates, next_cursor), vacancy = await asyncio.gather(
+        adb.list_candidates(vacancy_id, sort=sort, state=state or None, min_score=min_score, cursor=cursor or None),
+        adb.get_vacancy(vacancy_id))
+    vacancy_name = vacancy['name']
+    return templates.TemplateResponse("candidates.html", {"request": request, "candidates": candidates, "vacancy_id": vacancy_id, "vacancy_name": vacancy_name,
+                                                          "sort": sort, "state": state, "min_score": min_score, "next_cursor": next_cursor})
+
+@app.get("/api/vacancies/{vacancy_id}/candidates")
+async def candidates_api(vacancy_id: int, sort: str = 'score', state: Optional[str] = None,
+                         min_score: Optional[float] = None, max_score: Optional[float] = None,
+                         min_mark: Optional[int] = None, cursor: Optional[str] = None, limit: int = 50):
+    candidates, next_cursor = await adb.list_candidates(vacancy_id, sort=sort, state=state, min_score=min_score,
+                                                        max_score=max_score, min_mark=min_mark, cursor=cursor,
+                                                        limit=min(limit, 200))
+    return {"candidates": candidates, "next_cursor": next_cursor}
 
 @app.get("/vacancies/{vacancy_id}/candidates/{chat_id}")
-def read_candidate(request: Request, vacancy_id: int, chat_id: int):
-    candidate, marks, chat_history = get_candidate_details(chat_id, vacancy_id)
-    vacancy_name = get_vacancy(vacancy_id)['name']
+async def read_candidate(request: Request, vacancy_id: int, chat_id: int, before: Optional[int] = None):
+    (candidate, marks, chat_history, has_more), vacancy = await asyncio.gather(
+        adb.get_candidate_details(chat_id, vacancy_id, before),
+        adb.get_vacancy(vacancy_id))
+    vacancy_name = vacancy['name']
     return templates.TemplateResponse("candidate_detail.html", {
         "request": request,
         "candidate": candidate,
         "marks": marks,
         "chat_history": chat_history,
+        "has_more": has_more,
+        "vacancy_id": vacancy_id,
         "vacancy_name": vacancy_name
     })
 
@@ -115,44 +202,69 @@ def send_welcome(message):
     chat_id = message.chat.id
     chat_info = get_chat(chat_id)
     if chat_info:
-        msg = bot.send_message(chat_id, "Пожалуйста загрузите ваше актуальное резюме в формате .pdf")
-        bot.register_next_step_handler(msg, handle_document_upload)
+        set_chat_state(chat_id, AWAIT_RESUME)
+        bot.send_message(chat_id, "Пожалуйста загрузите ваше актуальное резюме в формате .pdf")
     else:
-        msg = bot.send_message(chat_id, "Здравствуйте! Введите ваше ФИО (в формате: Фамилия Имя Отчество)")
-        bot.register_next_step_handler(msg, process_fio)
+        set_chat_state(chat_id, AWAIT_FIO)
+        bot.send_message(chat_id, "Здравствуйте! Введите ваше ФИО (в формате: Фамилия Имя Отчество)")
 
 
-def process_fio(message):
+@bot.message_handler(func=lambda message: True, content_types=['text', 'document'])
+def dispatch_message(message):
+    """Route a message to the handler of the chat's persisted state."""
+    chat_state = get_chat_state(message.chat.id)
+    handler = state_handlers.get(chat_state['state']) if chat_state else None
+    if handler is None:
+        log.info(f'No handler for chat {message.chat.id} in state {chat_state}')
+        return
+    handler(message, chat_state)
+
+
+def process_fio(message, chat_state):
     chat_id = message.chat.id
     fio = message.text
     update_chat_info(chat_id, name=fio)
+    set_chat_state(chat_id, AWAIT_EMAIL)
     bot.send_message(chat_id, "Введите ваш email.")
-    bot.register_next_step_handler(message, process_email)
 
-def process_email(message):
+def process_email(message, chat_state):
     chat_id = message.chat.id
     email = message.text
     update_chat_info(chat_id, email = email)
+    set_chat_state(chat_id, AWAIT_RESUME)
     bot.send_message(chat_id, "Пожалуйста загрузите ваше актуальное резюме в формате .pdf")
-    bot.register_next_step_handler(message, handle_document_upload)
 
-def handle_document_upload(message):
+def handle_document_upload(message, chat_state):
     chat_id = message.chat.id
     #bot.send_message(chat_id, "Загрузите ваше резюме в формате .pdf в этот чат.")
     if message.content_type == 'document' and message.document.mime_type == 'application/pdf':
-        file_info = bot.get_file(message.document.file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        # Save the file to your desired location
-        resume_path = f"{chat_id}_resume.pdf"
-        with open(resume_path, 'wb') as new_file:
-            new_file.write(downloaded_file)
-        update_chat_info(chat_id, new_resume = extract_text_from_pdf(resume_path))
-        os.remove(resume_path)
+        if message.document.file_size and message.document.file_size > RESUME_MAX_BYTES:
+            bot.send_message(chat_id, f"Файл слишком большой, максимальный размер {RESUME_MAX_BYTES // (1024 * 1024)} МБ.")
+            return
+        # the same file uploaded again (file_unique_id) or the same content in a new file
+        # (content hash) is neither downloaded nor parsed again
+        resume = get_cached_resume(chat_id, message.document.file_unique_id)
+        if resume is None:
+            file_info = bot.get_file(message.document.file_id)
+            downloaded_file = bot.download_file(file_info.file_path)
+            data_hash = content_hash(downloaded_file)
+            resume = get_resume_by_hash(chat_id, data_hash)
+            if resume is None:
+                try:
+                    text = extract_text_from_pdf(downloaded_file)
+                except ResumeError as e:
+                    bot.send_message(chat_id, str(e))
+                    return
+                resume = {'content_hash': data_hash, 'text': text, 'is_current': False}
+            store_resume(message.document.file_unique_id, data_hash, resume['text'])
+        if not resume['is_current']:
+            update_chat_info(chat_id, new_resume = resume['text'])
+            set_chat_resume(chat_id, resume['content_hash'])
+        set_chat_state(chat_id, SELECT_VACANCY)
         bot.send_message(chat_id, "Резюме получено и обновлено.")
         show_vacancies(chat_id)
     else:
-        msg = bot.send_message(chat_id, "Please upload a valid .pdf file.")
-        bot.register_next_step_handler(msg, handle_document_upload)
+        bot.send_message(chat_id, "Please upload a valid .pdf file.")
 
 def show_vacancies(chat_id):
     vacancies = get_opened_vacancies()
@@ -186,12 +298,13 @@ def process_vacancy_selection(call):
             bot.send_message(chat_id, "Вернемся к интервью")
             initiate_llm_chat(chat_id,vacancy_id, session_id, cand, vacancy_requirements)
     else:
+        # written right away, the session id is needed to start the interview
         upsert_session(chat_id, vacancy_id, state = 'started')
         bot.send_message(chat_id, f"Вы выбрали вакансию: {vacancy_name}")
         cand = get_chat(chat_id)
         vacancy_requirements = get_requirements(vacancy_id)
         session_id = get_session(chat_id, vacancy_id)['id']
-        update_chat_info(chat_id, session_id=session_id)
+        write_behind.update_chat(chat_id, session_id=session_id)
         initiate_llm_chat(chat_id,vacancy_id, session_id,  cand, vacancy_requirements)
 
 
@@ -199,42 +312,84 @@ def process_vacancy_selection(call):
 
 
 
+def streamed_reply(chat_id):
+    """Message the interviewer reply is streamed into, None if streaming is off."""
+    if not STREAM_REPLIES:
+        return None
+    reply = ThrottledMessage(bot, chat_id, interval=STREAM_EDIT_INTERVAL)
+    reply.typing()
+    return reply
+
+def send_reply(chat_id, text, reply=None):
+    if reply is None:
+        bot.send_message(chat_id, text)
+    else:
+        reply.finish(text)
+
+def history_written(session_id):
+    """Wait for the batched chat history writes of the session before another process may read it."""
+    if not wait_history_written(session_id, UPDATE_DEADLINE):
+        log.warning(f'Chat history of session {session_id} is not written after {UPDATE_DEADLINE}s')
+
 def initiate_llm_chat(chat_id, vacancy_id, session_id, cand, vacancy_requirements):
     if cand:
-        greeting, chat_processor, init_cost = start_chat(session_id, cand, vacancy_requirements)
-        update_cost(session_id, init_cost)
+        reply = streamed_reply(chat_id)
+        greeting, chat_processor, init_cost = start_chat(session_id, cand, vacancy_requirements,
+                                                         on_question=reply)
+        write_behind.add_cost(session_id, init_cost)
         greeting_msg = greeting['messages'][-1].content
 
         if greeting['is_finished']:
-            upsert_session(chat_id, vacancy_id, 'finished')
+            # written before the chat state is cleared, not left in the buffer
+            write_behind.write_session_state(chat_id, vacancy_id, 'finished')
+            clear_chat_state(chat_id)
             bot.send_message(chat_id, 'Интервью на данную вакансию было завершено.')
         else:#update_chat_info(chat_id, new_state='STARTED')
-            bot.send_message(chat_id, greeting_msg)
-            bot.register_next_step_handler_by_chat_id(chat_id, interview_candidate, chat_processor, vacancy_id, session_id, cand, vacancy_requirements)
+            set_chat_state(chat_id, INTERVIEW, vacancy_id=vacancy_id, session_id=session_id)
+            send_reply(chat_id, greeting_msg, reply)
+            history_written(session_id)
     else:
+        set_chat_state(chat_id, AWAIT_RESUME)
         bot.send_message(chat_id, "Resume not found. Please upload your resume.")
-        bot.register_next_step_handler_by_chat_id(chat_id, handle_document_upload)
 
-#@bot.message_handler(func=lambda message: get_session_state(message.chat.id) == 'started')
-def interview_candidate(message,  chat_processor, vacancy_id, session_id,  cand, requirements):
+def interview_candidate(message, chat_state):
     chat_id = message.chat.id
+    vacancy_id = chat_state['vacancy_id']
+    session_id = chat_state['session_id']
+    if message.content_type != 'text':
+        return
+    # handler context is rebuilt from the persisted state, any worker can continue the interview
+    cand = get_chat(chat_id)
+    requirements = get_requirements(vacancy_id)
+    chat_processor = resume_chat(session_id, cand, requirements)
     input_msg = message.text
-    msg, finish, hist, cost  = chat_processor(input_msg)
-    update_cost(session_id, cost)
+    reply = streamed_reply(chat_id)
+    msg, finish, hist, cost  = chat_processor(input_msg, on_question=reply)
+    write_behind.add_cost(session_id, cost)
 
     if finish:
-        marks = evaluate(session_id, cand, requirements)
-        if marks:
-            id_marks = transform_marks(marks, get_requirements_ids(), vacancy_id)
-            update_marks(message.chat.id, id_marks)
-            upsert_session(chat_id, vacancy_id, 'finished')
-            bot.send_message(message.chat.id, msg)
-            bot.send_message(message.chat.id, "Интервью завершено.")
-        else:
-            log.info('Interview finished, but marks not found')
+        # written before the chat state is cleared, not left in the buffer
+        write_behind.write_session_state(chat_id, vacancy_id, 'finished')
+        # the evaluation may run in another process, it has to read the last answer
+        history_written(session_id)
+        clear_chat_state(chat_id)
+        # marks are set by the evaluation workers, off the candidate's path
+        enqueue_evaluation(session_id)
+        send_reply(message.chat.id, msg, reply)
+        bot.send_message(message.chat.id, "Интервью завершено.")
     else:
-        bot.send_message(message.chat.id, msg)
-        bot.register_next_step_handler_by_chat_id(chat_id, interview_candidate,  chat_processor, vacancy_id, session_id, cand, requirements)
+        send_reply(message.chat.id, msg, reply)
+        # the next answer may be handled by another process
+        history_written(session_id)
+
+
+# handlers of the persisted chat states, see back/chat_state.py
+state_handlers = {
+    AWAIT_FIO: process_fio,
+    AWAIT_EMAIL: process_email,
+    AWAIT_RESUME: handle_document_upload,
+    INTERVIEW: interview_candidate,
+}
 
 # @bot.message_handler(func=lambda message: True)
 # def echo(message):
@@ -245,16 +400,6 @@ def interview_candidate(message,  chat_processor, vacancy_id, session_id,  cand,
 
 
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from a PDF file."""
-    text = ""
-    with open(pdf_path, "rb") as file:
-        reader = PdfReader(file)
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-    return text
-
-
 if __name__ == "__main__":
     import uvicorn
 
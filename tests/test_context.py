@@ -0,0 +1,62 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from back import context
+from back.context import ContextBudget
+
+
+class Model:
+    def __init__(self):
+        self.calls = 0
+
+    def invoke(self, messages):
+        self.calls += 1
+        return AIMessage(content='summary')
+
+
+@pytest.fixture
+def summaries(monkeypatch):
+    """Stored summaries by session id, tokens are counted as words."""
+    stored = {}
+    monkeypatch.setattr(context, 'count_text_tokens', lambda text: len(text.split()))
+    monkeypatch.setattr(context, 'load_summary', lambda session_id: stored.get(session_id, (None, 0)))
+    monkeypatch.setattr(context, 'save_summary',
+                        lambda session_id, summary, covered: stored.__setitem__(session_id, (summary, covered)))
+    return stored
+
+
+def conversation(*words):
+    messages = [SystemMessage(content='start')]
+    for i, count in enumerate(words):
+        text = ' '.join(['word'] * count)
+        messages.append(HumanMessage(content=text) if i % 2 == 0 else AIMessage(content=text))
+    return messages
+
+
+def test_summarizes_aged_messages(summaries):
+    model = Model()
+    budget = ContextBudget(model, budget=100, keep_turns=1)
+    messages, stats = budget.fit(1, [SystemMessage(content='system')], conversation(50, 50, 1, 1, 1, 1))
+    assert model.calls == 1
+    assert summaries[1] == ('summary', 2)
+    assert stats['prompt_tokens'] <= 100
+
+
+def test_no_summary_call_when_nothing_aged(summaries):
+    # the stored summary alone pushes the prompt over the budget, the recent turns fit
+    summaries[1] = (' '.join(['word'] * 100), 2)
+    model = Model()
+    budget = ContextBudget(model, budget=100, keep_turns=1)
+    budget.fit(1, [SystemMessage(content='system')], conversation(200, 200, 1, 1, 1, 1))
+    assert model.calls == 0
+    assert summaries[1][1] == 2
+
+
+def test_no_summary_call_when_fixed_part_exceeds_budget(summaries):
+    model = Model()
+    budget = ContextBudget(model, budget=100, keep_turns=1)
+    fixed = [SystemMessage(content=' '.join(['word'] * 120))]
+    for turns in range(3, 6):
+        budget.fit(1, fixed, conversation(*[1] * (2 * turns)))
+    assert model.calls == 0
+    assert 1 not in summaries
@@ -0,0 +1,56 @@
+import logging
+
+from telebot.apihelper import ApiTelegramException
+
+from back.streaming import ThrottledMessage
+
+
+class Message:
+    message_id = 1
+
+
+class Bot:
+    def __init__(self, edit_errors=()):
+        self.edit_errors = list(edit_errors)
+        self.sent = []
+        self.edited = []
+
+    def send_message(self, chat_id, text):
+        self.sent.append(text)
+        return Message()
+
+    def edit_message_text(self, text, chat_id, message_id):
+        if self.edit_errors:
+            raise self.edit_errors.pop(0)
+        self.edited.append(text)
+
+
+def telegram_error(code, description, **result):
+    return ApiTelegramException('editMessageText', None, {'error_code': code, 'description': description, **result})
+
+
+def test_failed_edit_is_logged(caplog):
+    bot = Bot([telegram_error(429, 'Too Many Requests: retry after 5', parameters={'retry_after': 5})])
+    message = ThrottledMessage(bot, 7, interval=0)
+    message.update('the first part of the question')
+    with caplog.at_level(logging.WARNING, logger='back.streaming'):
+        message.update('the first part of the question and the rest')
+    assert bot.edited == []
+    assert 'Failed to edit message 1 in chat 7' in caplog.text
+
+
+def test_finish_retries_rate_limited_edit():
+    bot = Bot([telegram_error(429, 'Too Many Requests', parameters={'retry_after': 0})])
+    message = ThrottledMessage(bot, 7, interval=0)
+    message.update('the first part of the question')
+    message.finish('the whole question')
+    assert bot.edited == ['the whole question']
+    assert bot.sent == ['the first part of the question']
+
+
+def test_finish_sends_full_text_when_edit_fails():
+    bot = Bot([telegram_error(400, 'Bad Request: message to edit not found')])
+    message = ThrottledMessage(bot, 7, interval=0)
+    message.update('the first part of the question')
+    message.finish('the whole question')
+    assert bot.sent == ['the first part of the question', 'the whole question']